@@ -128,6 +128,22 @@ class FancyNFS4Unpacker(nfs4_pack.NFS4Unpacker):
         return data
         
         
+class LeaseClassifier(rpc.CallClassifier):
+    """Put calls that keep NFSv4 leases alive ahead of everything else
+
+    NULL, and COMPOUNDs starting with RENEW, SETCLIENTID or
+    SETCLIENTID_CONFIRM, go in class 0, as does all traffic of the
+    callback programs in cbprogs.  Other calls go in class 1.
+    """
+    def __init__(self, cbprogs=()):
+        classes = {(NFS4_PROGRAM, NFSPROC4_NULL) : 0}
+        for op in (OP_RENEW, OP_SETCLIENTID, OP_SETCLIENTID_CONFIRM):
+            classes[(NFS4_PROGRAM, NFSPROC4_COMPOUND, op)] = 0
+        for prog in cbprogs:
+            classes[(prog,)] = 0
+        rpc.CallClassifier.__init__(self, classes, 1,
+                                    [(NFS4_PROGRAM, NFSPROC4_COMPOUND)])
+
 # STUB
 class CBServer(rpc.RPCServer):
     def __init__(self, client, ipv6=False):
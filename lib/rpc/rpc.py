@@ -1,6 +1,6 @@
 # rpc.py - based on RFC 1831
 #
-# Requires python 2.3
+# Requires python 2.7
 # 
 # Written by Fred Isaman <iisaman@citi.umich.edu>
 # Copyright (C) 2004 University of Michigan, Center for 
@@ -14,6 +14,19 @@ import select
 import threading
 import errno
 import random
+import time
+import os
+import stat
+import fcntl
+import types
+import Queue
+import signal
+import sys
+import traceback
+import weakref
+import zlib
+import json
+from collections import deque, OrderedDict
 
 from rpc_const import *
 from rpc_type import *
@@ -38,6 +51,7 @@ if hasattr(select, "poll"):
     _writemask = select.POLLOUT | _stdmask
     _bothmask  = select.POLLOUT | select.POLLIN | _stdmask
 else:
+    _stdmask = 0
     _readmask = 1
     _writemask = 2
     _bothmask = 3
@@ -72,8 +86,13 @@ else:
             if fd in self._err: self._err.remove(fd)
 
         def poll(self, timeout=None):
-            # STUB - deal with timeout
-            read, write, err = select.select(self._in, self._out, self._err)
+            # Match select.poll, which uses milliseconds
+            if timeout is not None and timeout >= 0:
+                timeout = timeout / 1000.0
+            else:
+                timeout = None
+            read, write, err = select.select(self._in, self._out, self._err,
+                                             timeout)
             list = []
             for fd in read:
                 mask = select.POLLIN
@@ -95,7 +114,61 @@ else:
                 list.append((fd, mask))
             return list
     select.poll = my_poll
-        
+
+if hasattr(select, "epoll"):
+    class EPoll(object):
+        """Present select.epoll using the select.poll interface
+
+        If edge is set, descriptors are registered edge-triggered, so each
+        event is only reported once, and the caller must drain the
+        descriptor until it would block (see Server.run).
+        """
+        def __init__(self, edge=True, sizehint=-1):
+            self._epoll = select.epoll(sizehint)
+            self._fds = {}
+            self.edge = edge
+
+        def register(self, fd, eventmask=_bothmask):
+            if type(fd) != int:
+                fd = fd.fileno()
+            if self.edge:
+                eventmask |= select.EPOLLET
+            if fd not in self._fds:
+                self._epoll.register(fd, eventmask)
+            elif self._fds[fd] != eventmask:
+                self._epoll.modify(fd, eventmask)
+            self._fds[fd] = eventmask
+
+        def unregister(self, fd):
+            if type(fd) != int:
+                fd = fd.fileno()
+            del self._fds[fd]
+            self._epoll.unregister(fd)
+
+        def poll(self, timeout=None):
+            # Match select.poll, which uses milliseconds
+            if timeout is None or timeout < 0:
+                timeout = -1
+            else:
+                timeout = timeout / 1000.0
+            return self._epoll.poll(timeout)
+
+        def close(self):
+            self._epoll.close()
+
+_engines = {'poll' : select.poll}
+if hasattr(select, "epoll"):
+    _engines['epoll'] = EPoll
+    _engines['epoll-lt'] = lambda: EPoll(edge=False)
+    _default_engine = 'epoll'
+else:
+    _default_engine = 'poll'
+
+_blocking = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# Its value differs between platforms, so don't guess if python doesn't know
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+
 class RPCError(Exception):
     pass
 
@@ -136,67 +209,1040 @@ class RPCDeniedError(RPCError):
 
 ###################################################
 
+class Deferred(object):
+    """A result that will be supplied later, possibly by another thread
+
+    A handle_* method may return one of these instead of (a_stat, data),
+    and call callback((a_stat, data)) once the answer is known.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.called = False
+        self.result = None
+        self.callbacks = []
+        self.event = threading.Event()
+
+    def callback(self, result):
+        self.lock.acquire()
+        try:
+            if self.called:
+                raise RPCError("Deferred already called")
+            self.called = True
+            self.result = result
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        self.event.set()
+        for func in callbacks:
+            func(result)
+
+    def wait(self, timeout=None):
+        """Block until the result is known and return it
+
+        If the result is an exception instance, it is raised instead.
+        """
+        self.event.wait(timeout)
+        if not self.called:
+            raise socket.timeout("timed out")
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def add_callback(self, func):
+        """Call func(result), immediately if the result is already known"""
+        self.lock.acquire()
+        try:
+            if not self.called:
+                self.callbacks.append(func)
+                return
+        finally:
+            self.lock.release()
+        func(self.result)
+
+def defer_to_thread(func, *args):
+    """Run func(*args) in a new thread, returning a Deferred for its result
+
+    func is expected to give a handle_* style (a_stat, data) result.  If it
+    raises, the traceback is printed and the result is (SYSTEM_ERR, '').
+    """
+    d = Deferred()
+    def run():
+        try:
+            result = func(*args)
+        except Exception:
+            traceback.print_exc()
+            result = SYSTEM_ERR, ''
+        d.callback(result)
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    return d
+
+class WorkerPool(object):
+    """A fixed set of daemon threads running queued jobs
+
+    Threads do not survive a fork, so a forked process gets new ones (and
+    an empty queue) on its first submit.
+    """
+    def __init__(self, count, name="rpc worker"):
+        self.count = count
+        self.name = name
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(self.count):
+            t = threading.Thread(target=self._run,
+                                 name="%s %i" % (self.name, i))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, func, *args):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put((func, args))
+
+    def _run(self):
+        while 1:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception:
+                # Keep the thread for the next job
+                traceback.print_exc()
+
+def call_key(recv_data):
+    """Identify a call record for the duplicate request cache
+
+    Returns (xid, prog, vers, proc, crc32 of the arguments), or None if
+    recv_data is not a well formed call.  The credential and verifier are
+    skipped, since they may legitimately change on retransmission.
+    """
+    try:
+        xid, mtype, rpcvers, prog, vers, proc, flavor, length = \
+             struct.unpack_from('>8I', recv_data)
+        i = 32 + ((length + 3) & ~3)
+        flavor, length = struct.unpack_from('>2I', recv_data, i)
+        i += 8 + ((length + 3) & ~3)
+    except struct.error:
+        return None
+    if mtype != CALL or i > len(recv_data):
+        return None
+    return (xid, prog, vers, proc, zlib.crc32(buffer(recv_data, i)))
+
+class ReplyCache(object):
+    """Duplicate request cache of encoded replies
+
+    Entries are evicted least recently used first, to keep the total size
+    of cached replies under maxbytes.  Keys of calls whose reply is still
+    being computed are kept apart, and never evicted, so a retransmission
+    of a long running call is always recognised.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.entries = OrderedDict() # key -> (reply, size)
+        self.pending = set() # keys of calls in progress
+        self.hits = 0
+        self.misses = 0
+        self.inprogress = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """Return (found, reply) for key
+
+        If not found, key is marked as in progress.  If found with a reply
+        of None, the original call has not yet finished.
+        """
+        if key in self.pending:
+            self.inprogress += 1
+            return True, None
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            self.pending.add(key)
+            return False, None
+        self.entries[key] = entry # Now most recently used
+        self.hits += 1
+        return True, entry[0]
+
+    def store(self, key, reply):
+        """Record the reply for key; a reply of None forgets key"""
+        self.pending.discard(key)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if reply is None:
+            return
+        if isinstance(reply, str):
+            size = len(reply)
+        else:
+            size = sum([len(piece) for piece in reply])
+        if size > self.maxbytes:
+            return
+        self.entries[key] = (reply, size)
+        self.size += size
+        while self.size > self.maxbytes:
+            key, (reply, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits" : self.hits,
+                "misses" : self.misses,
+                "inprogress" : self.inprogress,
+                "evictions" : self.evictions,
+                "entries" : len(self.entries),
+                "pending" : len(self.pending),
+                "bytes" : self.size}
+
+def compound_op(recv_data):
+    """Return the first op of a call record with COMPOUND arguments
+
+    The arguments are taken to start with a tag, a minorversion and the
+    array of ops, as for NFSv4.  Returns None if there are no ops, or the
+    record can not be parsed that far.
+    """
+    try:
+        flavor, length = struct.unpack_from('>2I', recv_data, 24)
+        i = 32 + ((length + 3) & ~3)
+        flavor, length = struct.unpack_from('>2I', recv_data, i)
+        i += 8 + ((length + 3) & ~3)
+        length = struct.unpack_from('>I', recv_data, i)[0]
+        i += 8 + ((length + 3) & ~3)
+        count, op = struct.unpack_from('>2I', recv_data, i)
+    except struct.error:
+        return None
+    if not count:
+        return None
+    return op
+
+class CallClassifier(object):
+    """Sort call records into priority classes, 0 being the most urgent
+
+    classes maps keys to class numbers.  A key is (prog,), (prog, proc),
+    or for the (prog, proc) pairs in compounds, (prog, proc, op) with op
+    the first op of the COMPOUND.  The most specific key found decides,
+    and calls matching none are put in class default.  Arguments of calls
+    using RPCSEC_GSS may be wrapped, so their ops are not looked at.
+    """
+    def __init__(self, classes=None, default=1, compounds=()):
+        self.classes = classes or {}
+        self.default = default
+        self.compounds = set(compounds)
+
+    def classify(self, recv_data):
+        """Return the class of a call record"""
+        try:
+            xid, mtype, rpcvers, prog, vers, proc, flavor = \
+                 struct.unpack_from('>7I', recv_data)
+        except struct.error:
+            return self.default
+        classes = self.classes
+        if (prog, proc) in self.compounds and flavor != RPCSEC_GSS:
+            out = classes.get((prog, proc, compound_op(recv_data)))
+            if out is not None:
+                return out
+        out = classes.get((prog, proc))
+        if out is None:
+            out = classes.get((prog,), self.default)
+        return out
+
+class Metrics(object):
+    """Call statistics for each (program, version, procedure)
+
+    For each procedure this counts calls, errors, and bytes received and
+    sent, and keeps a histogram of latencies.  Bucket i of the histogram
+    counts latencies under 2**i microseconds (and at least half that).
+    One Metrics may be shared by several clients or servers.
+    """
+    buckets = 32 # The last bucket holds anything over half an hour
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = {} # key -> [calls, errors, in, out, usecs, histogram]
+
+    def record(self, key, latency, bytes_in, bytes_out, error=False):
+        """Count one call of key which took latency seconds"""
+        usecs = int(latency * 1000000)
+        bucket = min(usecs.bit_length(), self.buckets - 1)
+        self.lock.acquire()
+        try:
+            entry = self.procs.get(key)
+            if entry is None:
+                entry = self.procs[key] = [0, 0, 0, 0, 0,
+                                           [0] * self.buckets]
+            entry[0] += 1
+            if error:
+                entry[1] += 1
+            entry[2] += bytes_in
+            entry[3] += bytes_out
+            entry[4] += usecs
+            entry[5][bucket] += 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the statistics as a dict keyed by 'prog/vers/proc'"""
+        out = {}
+        self.lock.acquire()
+        try:
+            for key, entry in self.procs.items():
+                calls, errors, bytes_in, bytes_out, usecs, hist = entry
+                out["%i/%i/%i" % key] = {
+                    "calls" : calls,
+                    "errors" : errors,
+                    "bytes_in" : bytes_in,
+                    "bytes_out" : bytes_out,
+                    "latency_usecs" : usecs,
+                    # [upper bound in usecs, count] for nonempty buckets
+                    "histogram" : [[1 << i, n] for i, n in enumerate(hist)
+                                   if n],
+                    }
+        finally:
+            self.lock.release()
+        return out
+
+    def to_json(self):
+        return json.dumps(self.stats(), sort_keys=True, indent=1)
+
+    def reset(self):
+        self.lock.acquire()
+        self.procs = {}
+        self.lock.release()
+
+CAPTURE_MAGIC = "RPCCAP\0\1"
+CAPTURE_HEADER = ">dII"
+
+class Capture(object):
+    """Append raw call records to a capture file
+
+    The file starts with CAPTURE_MAGIC, followed by each record as a
+    header packed with CAPTURE_HEADER (time received or sent, connection
+    id, and length), then the record itself without its record marks.
+    Use read_capture to read one back.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.fd = open(path, "wb")
+        self.fd.write(CAPTURE_MAGIC)
+
+    def record(self, connid, data):
+        header = struct.pack(CAPTURE_HEADER, time.time(),
+                             connid & 0xffffffffL, len(data))
+        self.lock.acquire()
+        try:
+            self.fd.write(header)
+            self.fd.write(data)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.fd.close()
+        finally:
+            self.lock.release()
+
+def read_capture(path):
+    """Yield (time, connection id, record) for each record in a capture"""
+    fd = open(path, "rb")
+    try:
+        if fd.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise RPCError("%s is not an RPC capture file" % path)
+        size = struct.calcsize(CAPTURE_HEADER)
+        while 1:
+            header = fd.read(size)
+            if len(header) < size:
+                return
+            stamp, connid, length = struct.unpack(CAPTURE_HEADER, header)
+            data = fd.read(length)
+            if len(data) < length:
+                return # Truncated by a crash
+            yield stamp, connid, data
+    finally:
+        fd.close()
+
+def connection_id(sock):
+    """Return a number identifying a connection, for captures"""
+    try:
+        return sock.fileno()
+    except AttributeError:
+        return id(sock)
+
+class RecordTooLarge(RPCError):
+    pass
+
+class RecordReader(object):
+    """Reassemble record marked data that arrives in arbitrary pieces
+
+    Fragment payloads are kept as a list of the received strings, so each
+    byte is copied only when the record is finally joined.  If maxrecord
+    is set, a record is rejected as soon as its fragment headers claim
+    more than that many bytes, before any of it is buffered.
+    """
+    def __init__(self, maxrecord=None):
+        self.maxrecord = maxrecord
+        self.mark = ''     # partial record mark
+        self.need = None   # payload bytes missing from current fragment
+        self.last = False  # current fragment ends the record
+        self.pieces = []   # received payload of the current record
+        self.size = 0      # total size of current record, from the marks
+
+    def feed(self, data):
+        """Consume received data, returning a list of completed records"""
+        records = []
+        pos = 0
+        n = len(data)
+        while pos < n:
+            if self.need is None:
+                take = min(4 - len(self.mark), n - pos)
+                self.mark += data[pos:pos + take]
+                pos += take
+                if len(self.mark) < 4:
+                    break
+                count = struct.unpack('>I', self.mark)[0]
+                self.mark = ''
+                self.last = count & 0x80000000L
+                self.need = count & 0x7fffffffL
+                self.size += self.need
+                if self.maxrecord is not None and self.size > self.maxrecord:
+                    raise RecordTooLarge("Record of at least %i bytes "
+                                         "exceeds limit of %i" %
+                                         (self.size, self.maxrecord))
+            take = min(self.need, n - pos)
+            if take == n:
+                self.pieces.append(data)
+            elif take:
+                self.pieces.append(data[pos:pos + take])
+            pos += take
+            self.need -= take
+            if not self.need:
+                self.need = None
+                if self.last:
+                    records.append(''.join(self.pieces))
+                    self.pieces = []
+                    self.size = 0
+        return records
+
+###################################################
+
 # Add some record marking functions to sockets
 # FRED - is there a cleaner (class based) way to do this?
 
+class _RecvBuffer(object):
+    """Bytes read ahead from a socket, held in a reusable buffer
+
+    buf[start:end] has been received but not yet consumed.  A record
+    being reassembled from start on has size bytes in place so far, and
+    its next record mark at offset pos; these survive a receive being
+    interrupted, for instance by a timeout, so the next one carries on.
+    """
+    readahead = 65536
+
+    def __init__(self, size=2 * readahead):
+        self.buf = bytearray(size)
+        self.start = self.end = 0
+        self.size = self.pos = 0
+
+    def fill(self, sock, n):
+        """Read from sock until at least n unconsumed bytes are buffered
+
+        Reads ask for what is missing, but at least readahead bytes, so
+        several fragments or small records can arrive with a single recv.
+        """
+        if self.end - self.start >= n:
+            return
+        if self.start + n + self.readahead > len(self.buf):
+            if n + self.readahead > len(self.buf):
+                new = bytearray(max(n + self.readahead, 2 * len(self.buf)))
+                new[:self.end - self.start] = \
+                    memoryview(self.buf)[self.start:self.end]
+                self.buf = new
+                self.end -= self.start
+                self.start = 0
+            else:
+                self.compact()
+        view = memoryview(self.buf)
+        while self.end - self.start < n:
+            want = max(n - (self.end - self.start), self.readahead)
+            count = sock.recv_into(view[self.end:self.end + want])
+            if not count:
+                raise socket.error("Connection closed")
+            self.end += count
+
+    def compact(self):
+        """Move unconsumed data to the front of the buffer"""
+        used = self.end - self.start
+        self.buf[:used] = self.buf[self.start:self.end]
+        self.start, self.end = 0, used
+
+# Receive buffers, one per socket
+_recvbufs = weakref.WeakKeyDictionary()
+
+def _get_recvbuf(sock):
+    rb = _recvbufs.get(sock)
+    if rb is None:
+        rb = _recvbufs[sock] = _RecvBuffer()
+    return rb
+
 def _recv_all(self, n):
     """Receive n bytes, or raise an error"""
-    data = ""
-    while n > 0:
-        newdata = self.recv(n)
-        count = len(newdata)
-        if not count:
-            raise socket.error("Connection closed")
-        data += newdata
-        n -= count
+    rb = _get_recvbuf(self)
+    rb.fill(self, n)
+    data = str(rb.buf[rb.start:rb.start + n])
+    rb.start += n
     return data
 
-def _recv_record(self):
-    """Receive data sent using record marking standard"""
+def _recv_record_view(self):
+    """Receive data sent using record marking standard
+
+    The record is reassembled in place in a buffer kept for this socket,
+    and a memoryview of it is returned.  The view is only valid until the
+    next receive on the socket.
+    """
+    rb = _get_recvbuf(self)
+    if rb.start >= len(rb.buf) // 2:
+        # Cheap here, as only read ahead data is moved
+        rb.compact()
+    # The record is assembled just after the first record mark, each
+    # later fragment being moved down over the marks preceding it.
+    # Offsets are from rb.start, since fill may move the data.  Progress
+    # is only saved in rb once a fragment has been moved, so if fill
+    # raises the next call starts again from an intact record mark.
     last = False
-    data = ""
     while not last:
-        rec_mark = self.recv_all(4)
-        count = struct.unpack('>I', rec_mark)[0]
+        pos = rb.pos
+        rb.fill(self, pos + 4)
+        count = struct.unpack_from('>I', rb.buf, rb.start + pos)[0]
         last = count & 0x80000000L
         if last:
             count &= 0x7fffffffL
-        data += self.recv_all(count)
-    return data
+        rb.fill(self, pos + 4 + count)
+        size = rb.size
+        if pos != size:
+            src = rb.start + pos + 4
+            dest = rb.start + 4 + size
+            rb.buf[dest:dest + count] = rb.buf[src:src + count]
+        rb.size = size + count
+        rb.pos = pos + 4 + count
+    view = memoryview(rb.buf)[rb.start + 4:rb.start + 4 + rb.size]
+    rb.start += rb.pos
+    rb.size = rb.pos = 0
+    return view
 
-def _send_record(self, data, chunksize=2048):
-    """Send data using record marking standard"""
-    dlen = len(data)
-    i = last = 0
-    while not last:
-        chunk = data[i:i+chunksize]
-        i += chunksize
-        if i >= dlen:
-            last = 0x80000000L
-        mark = struct.pack('>I', last | len(chunk))
-        self.sendall(mark + chunk)
+def _recv_record(self):
+    """Receive data sent using record marking standard"""
+    return self.recv_record_view().tobytes()
+
+def _send_record(self, data, chunksize=None):
+    """Send data using record marking standard
+
+    data may be a string or a list of strings, which are sent without
+    being joined, as a single fragment unless chunksize is given.
+    """
+    self.sendall_buffers(frame_record(data, chunksize))
+
+def _send_records(self, records, chunksize=None):
+    """Send a list of records, as for send_record, all in one go"""
+    bufs = []
+    for data in records:
+        bufs.extend(frame_record(data, chunksize))
+    self.sendall_buffers(bufs)
+
+def _sendall_buffers(self, bufs):
+    """Send all of a list of buffers, using as few calls as possible"""
+    bufs = deque(bufs)
+    while bufs:
+        consume_buffers(bufs, send_buffers(self, bufs))
+
+def frame_record(reply, fragsize=None):
+    """Return a list of buffers sending reply using record marking
+
+    reply is a string or a list of strings.  The data is split into
+    fragments of at most fragsize bytes (one fragment if fragsize is None)
+    using memoryview slices, so it is never copied.
+    """
+    if isinstance(reply, str):
+        reply = [reply]
+    reply = [piece for piece in reply if len(piece)]
+    total = sum([len(piece) for piece in reply])
+    if not fragsize or total <= fragsize:
+        return [struct.pack('>I', 0x80000000L | total)] + reply
+    out = []
+    left = total # bytes not yet assigned to a fragment
+    room = 0     # bytes still to go in the current fragment
+    for piece in reply:
+        view = memoryview(piece)
+        i = 0
+        while i < len(view):
+            if not room:
+                room = min(fragsize, left)
+                left -= room
+                last = (not left) and 0x80000000L or 0
+                out.append(struct.pack('>I', last | room))
+            take = min(room, len(view) - i)
+            out.append(view[i:i + take])
+            i += take
+            room -= take
+    return out
+
+IOV_MAX = 1024
+SEND_COALESCE = 65536
+
+def send_buffers(sock, bufs):
+    """Send as much as possible from a sequence of buffers in one call
+
+    Returns the number of bytes sent.
+    """
+    if hasattr(sock, "sendmsg"):
+        return sock.sendmsg([b for i, b in zip(xrange(IOV_MAX), bufs)])
+    # No sendmsg, so join leading small buffers into one send, and send
+    # big ones in place
+    first = bufs[0]
+    if len(first) >= SEND_COALESCE or len(bufs) == 1:
+        return sock.send(first)
+    small = []
+    size = 0
+    for b in bufs:
+        if size + len(b) > SEND_COALESCE and small:
+            break
+        if isinstance(b, memoryview):
+            b = b.tobytes()
+        small.append(b)
+        size += len(b)
+    return sock.send(''.join(small))
+
+def consume_buffers(bufs, count):
+    """Drop count bytes from the front of a deque of buffers"""
+    while count:
+        n = len(bufs[0])
+        if count < n:
+            bufs[0] = memoryview(bufs[0])[count:]
+            return
+        bufs.popleft()
+        count -= n
 
 socket._socketobject.recv_all = _recv_all
+socket._socketobject.recv_record_view = _recv_record_view
 socket._socketobject.recv_record = _recv_record
 socket._socketobject.send_record = _send_record
+socket._socketobject.send_records = _send_records
+socket._socketobject.sendall_buffers = _sendall_buffers
+
+class DatagramSocket(object):
+    """Give a connected UDP socket the record interface of a TCP one
+
+    Each record is sent as a single datagram.
+    """
+    maxsize = 65535
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send_record(self, data, chunksize=None):
+        if not isinstance(data, str):
+            data = ''.join(data)
+        if len(data) > self.maxsize:
+            raise RPCError("Record of %i bytes is too big for UDP" % len(data))
+        self.sock.send(data)
+
+    def send_records(self, records, chunksize=None):
+        for data in records:
+            self.send_record(data)
+
+    def recv_record(self):
+        return self.sock.recv(self.maxsize)
+
+    def recv_record_view(self):
+        return memoryview(self.recv_record())
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class LoopbackSocket(object):
+    """Give an RPCServer in this process the record interface of a socket
+
+    Each call record sent is passed to the server's compute_reply, on the
+    poll loop thread if the server's loop is running.  Otherwise the
+    sending thread stands in for the loop, calling compute_reply itself
+    and running anything handlers queue with call_soon until the reply
+    is ready.  Only one thread at a time does so for each server, since
+    handlers need not be thread safe.
+    """
+    def __init__(self, server, timeout=None):
+        self.server = server
+        self.timeout = timeout
+        self.replies = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def send_record(self, data, chunksize=None):
+        if self.closed:
+            raise socket.error(errno.EBADF, "Loopback socket is closed")
+        if not isinstance(data, str):
+            data = ''.join(data)
+        if self.server.loopthread is not None:
+            reply = self.compute_on_loop(data)
+        else:
+            self.server._loopback_lock.acquire()
+            try:
+                reply = self.server.compute_reply(data)
+                if isinstance(reply, Deferred):
+                    reply = self.run_until(reply)
+            finally:
+                self.server._loopback_lock.release()
+        if reply is None:
+            # Dropped, as a real server would
+            return
+        self.cond.acquire()
+        try:
+            self.replies.append(''.join(reply))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def send_records(self, records, chunksize=None):
+        for data in records:
+            self.send_record(data)
+
+    def compute_on_loop(self, data):
+        """Have the server's running loop compute the reply to data"""
+        d = Deferred()
+        def compute():
+            try:
+                reply = self.server.compute_reply(data)
+            except Exception, e:
+                d.callback(e)
+                return
+            if isinstance(reply, Deferred):
+                reply.add_callback(d.callback)
+            else:
+                d.callback(reply)
+        self.server.call_soon(compute)
+        return d.wait(self.timeout)
+
+    def run_until(self, d):
+        """Run the server's queued calls until d has fired"""
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while not d.called:
+            wait = None
+            if self.timeout is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise socket.timeout("timed out")
+            select.select([self.server._wakeup_r], [], [], wait)
+            self.server.run_calls()
+        if isinstance(d.result, Exception):
+            raise d.result
+        return d.result
+
+    def recv_record(self):
+        self.cond.acquire()
+        try:
+            if not self.replies and not self.closed:
+                self.cond.wait(self.timeout)
+            if self.replies:
+                return self.replies.popleft()
+            if self.closed:
+                raise socket.error(errno.EBADF, "Loopback socket is closed")
+            raise socket.timeout("timed out")
+        finally:
+            self.cond.release()
+
+    def recv_record_view(self):
+        return memoryview(self.recv_record())
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notifyAll()
+        self.cond.release()
+
+class ConnectionPool(object):
+    """A bounded set of connections, each leased to one user at a time
+
+    connect is called to open new connections.  At most maxconns are open
+    at once (None for no limit), and lease waits for one to be released
+    when all are in use.  Connections left idle for more than idletime
+    seconds are closed the next time the pool is used.
+    """
+    def __init__(self, connect, maxconns=None, idletime=60.0):
+        self.connect = connect
+        self.maxconns = maxconns
+        self.idletime = idletime
+        self.cond = threading.Condition()
+        self.idle = deque() # (release time, connection), newest last
+        self.count = 0      # connections open, leased or idle
+
+    def lease(self, timeout=None, connect=None):
+        """Return a connection for the caller's exclusive use
+
+        An idle connection is reused if possible.  If connect is given, a
+        new connection is always opened with it instead, closing an idle
+        one if that is needed to stay within maxconns.
+        """
+        self.cond.acquire()
+        try:
+            self.reap()
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while True:
+                while self.idle and connect is None:
+                    out = self.idle.pop()[1]
+                    if self.usable(out):
+                        return out
+                    self._close(out)
+                if self.maxconns is None or self.count < self.maxconns:
+                    break
+                if self.idle:
+                    self._close(self.idle.popleft()[1])
+                    break
+                wait = None
+                if timeout is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        raise RPCError("No connection free after %s seconds" %
+                                       timeout)
+                self.cond.wait(wait)
+            self.count += 1
+        finally:
+            self.cond.release()
+        try:
+            return (connect or self.connect)()
+        except:
+            self.cond.acquire()
+            self.count -= 1
+            self.cond.notify()
+            self.cond.release()
+            raise
+
+    def release(self, conn):
+        """Return a leased connection to the pool for reuse"""
+        self.cond.acquire()
+        try:
+            self.idle.append((time.time(), conn))
+            self.reap()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def discard(self, conn):
+        """Close a leased connection which can not be reused"""
+        self.cond.acquire()
+        try:
+            self._close(conn)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def take(self, conn):
+        """Lease conn itself, if it is idle
+
+        Returns True if it was, and is now leased to the caller.
+        """
+        self.cond.acquire()
+        try:
+            for i, (when, idle) in enumerate(self.idle):
+                if idle is conn:
+                    del self.idle[i]
+                    return True
+            return False
+        finally:
+            self.cond.release()
+
+    def reap(self):
+        """Close connections idle for longer than idletime"""
+        if self.idletime is None:
+            return
+        limit = time.time() - self.idletime
+        while self.idle and self.idle[0][0] < limit:
+            self._close(self.idle.popleft()[1])
+
+    def close(self):
+        """Close all idle connections"""
+        self.cond.acquire()
+        try:
+            while self.idle:
+                self._close(self.idle.popleft()[1])
+        finally:
+            self.cond.release()
+
+    def usable(self, conn):
+        """Return False if an idle connection has become readable
+
+        An idle connection should have nothing to read, so this means the
+        peer has closed it or sent something unexpected.
+        """
+        if not hasattr(conn, "fileno"):
+            return True
+        try:
+            return not select.select([conn], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+
+    def _close(self, conn):
+        self.count -= 1
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+_xid_struct = struct.Struct('>I')
+
+# Fixed layout words at the start of reply and call records, for
+# unpack_reply_header and unpack_call_header
+_reply_struct = struct.Struct('>5I') # xid, mtype, stat, verf flavor, length
+_call_struct = struct.Struct('>8I')  # xid, mtype, rpcvers, prog, vers, proc,
+                                     # cred flavor, length
+_auth_struct = struct.Struct('>2I')  # flavor, length
+_fast_flavors = (AUTH_NONE, AUTH_SYS)
+
+def unpack_reply_header(data):
+    """Decode the header of an accepted SUCCESS reply using struct
+
+    Returns the rpc_msg and the offset of the results, or None if the
+    reply is anything else, or has a verifier other than AUTH_NONE or
+    AUTH_SYS, and so needs the generic unpack_rpc_msg.
+    """
+    try:
+        xid, mtype, stat, flavor, vlen = _reply_struct.unpack_from(data)
+        if mtype != REPLY or stat != MSG_ACCEPTED or \
+               flavor not in _fast_flavors or vlen > 400:
+            return None
+        pos = 20 + ((vlen + 3) & ~3)
+        if _xid_struct.unpack_from(data, pos)[0] != SUCCESS:
+            return None
+    except struct.error:
+        return None
+    verf = opaque_auth(flavor, data[20:20 + vlen])
+    areply = accepted_reply(verf, rpc_reply_data(SUCCESS, ''))
+    body = reply_body(MSG_ACCEPTED, areply, None)
+    return rpc_msg(xid, rpc_msg_body(REPLY, rbody=body)), pos + 4
+
+def unpack_call_header(data):
+    """Decode the header of a call using struct
+
+    Returns the rpc_msg and the offset of the arguments, or None if the
+    credential or verifier is other than AUTH_NONE or AUTH_SYS, and so
+    needs the generic unpack_rpc_msg.
+    """
+    try:
+        xid, mtype, rpcvers, prog, vers, proc, cflavor, clen = \
+             _call_struct.unpack_from(data)
+        if mtype != CALL or cflavor not in _fast_flavors or clen > 400:
+            return None
+        pos = 32 + ((clen + 3) & ~3)
+        vflavor, vlen = _auth_struct.unpack_from(data, pos)
+        if vflavor not in _fast_flavors or vlen > 400:
+            return None
+    except struct.error:
+        return None
+    cred = opaque_auth(cflavor, data[32:32 + clen])
+    verf = opaque_auth(vflavor, data[pos + 8:pos + 8 + vlen])
+    end = pos + 8 + ((vlen + 3) & ~3)
+    if end > len(data):
+        return None
+    body = call_body(rpcvers, prog, vers, proc, cred, verf)
+    return rpc_msg(xid, rpc_msg_body(CALL, cbody=body)), end
+
+def unix_path(host):
+    """Return the socket path of a 'unix:/path' endpoint, else None"""
+    if isinstance(host, str) and host.startswith("unix:"):
+        return host[5:]
+    return None
 
 #################################################
 
 class RPCClient(object):
+    """Client for an RPC program
+
+    proto is 'tcp' or 'udp'.  A call which gets no reply is sent again
+    with the same xid up to retrans times (by default 3 over UDP and none
+    over TCP) before failing with socket.timeout after timeout seconds.
+    The first try waits timeo seconds and each later one backoff times
+    longer; by default timeo is chosen so the tries use up the timeout.
+
+    If the connection fails, it is replaced up to reconnects times per
+    call, backing off in the same way, and every call still awaiting a
+    reply is sent again.  The new connection is made from the same port
+    where possible, so the server can tell these are retransmissions.
+
+    A host of the form 'unix:/path' connects to a server on the Unix
+    socket at /path instead, and port is ignored.  host may also be an
+    RPCServer instance, whose compute_reply is then called directly, with
+    no sockets involved (see LoopbackSocket).
+
+    Connections come from a pool of at most maxconns (None for no limit).
+    A thread leases one when it sends a call and returns it once all its
+    replies are in, and connections idle for idletime seconds are closed.
+
+    If metrics is a Metrics instance, every call is counted in it.  If
+    capture is a Capture, every call record sent is appended to it.
+    """
     def __init__(self, host='localhost', port=51423,
                  program=None, version=None, sec_list=None, timeout=15.0,
-                 uselowport=False, usenonrandomxid=False,ipv6=False):
+                 uselowport=False, usenonrandomxid=False,ipv6=False,
+                 fragsize=None, proto='tcp', retrans=None,
+                 maxconns=None, idletime=60.0,
+                 timeo=None, backoff=2.0, reconnects=1, metrics=None,
+                 capture=None):
         self.debug = 0
+        self.metrics = metrics
+        self.capture = capture
+        if proto not in ('tcp', 'udp'):
+            raise RPCError("Unknown protocol %r" % proto)
+        self.proto = proto
+        if retrans is None:
+            retrans = (proto == 'udp') and 3 or 0
+        self.retrans = retrans
+        self.backoff = backoff
+        if timeo is None:
+            timeo = float(timeout) / sum([backoff ** i
+                                          for i in range(retrans + 1)])
+        self.timeo = timeo
+        self.reconnects = reconnects
+        # Size of record fragments sent, or None to send one per call
+        self.fragsize = fragsize
         t = threading.currentThread()
         self.lock = threading.Lock()
         self.remotehost = host
         self.remoteport = port
+        self.unixpath = unix_path(host)
+        if isinstance(host, RPCServer):
+            self.loopback = host
+        else:
+            self.loopback = None
+        if self.unixpath is not None or self.loopback is not None:
+            if proto != 'tcp':
+                raise RPCError("Local transports are stream only")
+            # Name the server, e.g. for GSS, by the host we share with it
+            self.servername = socket.gethostname()
+        else:
+            self.servername = host
         self.timeout = timeout
         self.uselowport = uselowport
-        self._socket = {}
+        self._socket = {} # connection leased by each thread
+        self._lastsocket = {} # connection each thread last released
+        self.pool = ConnectionPool(self.connect, maxconns, idletime)
         self.ipv6 = ipv6
         self.getsocket() # init socket, is this needed here?
-        self.ipaddress = self.socket.getsockname()[0]
+        if self.unixpath is not None or self.loopback is not None:
+            self.ipaddress = "127.0.0.1"
+        else:
+            self.ipaddress = self.socket.getsockname()[0]
+        self._release_socket()
         self._rpcpacker = {t : rpc_pack.RPCPacker()}
         self._rpcunpacker = {t : rpc_pack.RPCUnpacker('')}
         self.default_prog = program
@@ -210,6 +1256,7 @@ class RPCClient(object):
             self.xid = random.randint(0, 0xFFFFFFFF)
 
         self._xidlist = {}
+        self._headers = {} # packed call headers after the xid, see below
         if sec_list is None:
             sec_list = [SecAuthNone()]
         self.sec_list = sec_list
@@ -238,31 +1285,85 @@ class RPCClient(object):
                     print "Could not use low port"
                     return
 
+    def connect(self, bind=True, local=None):
+        """Return a new socket connected to the server
+
+        If local is given, the socket is bound to that address, if it is
+        still free, so the server sees the same client as before.
+        """
+        if self.loopback is not None:
+            return LoopbackSocket(self.loopback, self.timeout)
+        if self.unixpath is not None:
+            out = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            out.connect(self.unixpath)
+            out.settimeout(self.timeout)
+            return out
+        if self.proto == 'udp':
+            type = socket.SOCK_DGRAM
+        else:
+            type = socket.SOCK_STREAM
+        if not self.ipv6:
+            out = socket.socket(socket.AF_INET, type)
+        else:
+            out = socket.socket(socket.AF_INET6, type)
+        if local is not None:
+            out.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                out.bind(local)
+                out.connect((self.remotehost, self.remoteport))
+            except socket.error, why:
+                if why[0] not in (errno.EADDRINUSE, errno.EADDRNOTAVAIL):
+                    raise
+                out.close()
+                return self.connect(bind=False)
+        else:
+            if bind and self.uselowport:
+                self.bindsocket(out)
+            out.connect((self.remotehost, self.remoteport))
+        out.settimeout(self.timeout)
+        if self.proto == 'udp':
+            out = DatagramSocket(out)
+        return out
+
     def getsocket(self):
         t = threading.currentThread()
         self.lock.acquire()
-        try:
-            if t in self._socket:
-                out = self._socket[t]
-            else:
-                if not self.ipv6:
-                    out = self._socket[t] = socket.socket(socket.AF_INET,
-                                                  socket.SOCK_STREAM)
-                else:
-                    out = self._socket[t] = socket.socket(socket.AF_INET6,
-                                                  socket.SOCK_STREAM)
-                if self.uselowport:
-                    self.bindsocket(out)
-                out.connect((self.remotehost, self.remoteport))
-                out.settimeout(self.timeout)
-        except:
-            raise
-        finally:
+        out = self._socket.get(t)
+        self.lock.release()
+        if out is None:
+            # Only this thread touches its own entry, so no need to lock
+            # while waiting for the pool
+            out = self.pool.lease(self.timeout)
+            self.lock.acquire()
+            self._socket[t] = out
             self.lock.release()
         return out
 
     socket = property(getsocket)
 
+    def _release_socket(self, discard=False):
+        """Give up this thread's connection, returning it to the pool
+
+        If discard is set the connection is closed instead, and calls
+        still outstanding on it are forgotten.
+        """
+        t = threading.currentThread()
+        self.lock.acquire()
+        out = self._socket.pop(t, None)
+        if discard and t in self._xidlist:
+            self._xidlist[t].clear()
+        if discard or out is None:
+            self._lastsocket.pop(t, None)
+        else:
+            self._lastsocket[t] = out
+        self.lock.release()
+        if out is None:
+            return
+        if discard:
+            self.pool.discard(out)
+        else:
+            self.pool.release(out)
+
     def getrpcpacker(self):
         t = threading.currentThread()
         self.lock.acquire()
@@ -280,8 +1381,8 @@ class RPCClient(object):
         if t in self._rpcunpacker:
             out = self._rpcunpacker[t]
         else:
-            self._rpcpacker[t] = gss_pack.GSSPacker()
-            out = self._rpcunpacker[t] = gss_pack.GSSUnpacker('')
+            self._rpcpacker[t] = rpc_pack.RPCPacker()
+            out = self._rpcunpacker[t] = rpc_pack.RPCUnpacker('')
         self.lock.release()
         return out
 
@@ -293,6 +1394,9 @@ class RPCClient(object):
             self.rhead = None    # unpacked reply header
             self.rdata = None    # unsecured reply data
             self.proc = proc     # unpacked proc from header
+            self.key = None      # (prog, vers, proc), for metrics
+            self.start = None    # time sent, for metrics
+            self.rsize = 0       # size of reply record
 
         def __repr__(self):
             return "%s\n%s" % (self.header, self.data)
@@ -315,23 +1419,38 @@ class RPCClient(object):
         return out
 
     def reconnect(self):
+        """Replace this thread's connection with a new one
+
+        Like the Linux client, the new connection keeps the old one's port,
+        so the server's duplicate request cache recognises the calls which
+        replay sends again.  If the thread has already returned its
+        connection to the pool, that one is closed instead, unless another
+        thread has taken it since.
+        """
         t = threading.currentThread()
         self.lock.acquire()
-        try:
-            self._socket[t].close()
-            if not self.ipv6:
-                out = self._socket[t] = socket.socket(socket.AF_INET,
-                                                  socket.SOCK_STREAM)
-            else:
-                out = self._socket[t] = socket.socket(socket.AF_INET6,
-                                                  socket.SOCK_STREAM)
-            # out.bind
-            out.connect((self.remotehost, self.remoteport))
-            out.settimeout(self.timeout)
-        except:
-            raise
-        finally:
-            self.lock.release()
+        old = self._socket.pop(t, None)
+        last = self._lastsocket.pop(t, None)
+        self.lock.release()
+        if old is None and last is not None and self.pool.take(last):
+            old = last
+        local = None
+        if old is not None:
+            if self.loopback is None and self.unixpath is None:
+                try:
+                    local = old.getsockname()
+                    if self.proto == 'tcp':
+                        # Reset rather than close, so the port is free now
+                        old.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+                except socket.error:
+                    local = None
+            self.pool.discard(old)
+        out = self.pool.lease(self.timeout,
+                              lambda: self.connect(bind=False, local=local))
+        self.lock.acquire()
+        self._socket[t] = out
+        self.lock.release()
         return out
         
     def send(self, procedure, data='', program=None, version=None):
@@ -347,61 +1466,179 @@ class RPCClient(object):
         xid = self.get_new_xid()
         header, cred = self.get_call_header(xid, program, version, procedure)
         data = self.security.secure_data(data, cred)
+        self.add_outstanding_xids(xid, header, data, cred, procedure)
+        if self.metrics is not None:
+            self.start_call(self.get_outstanding_xids()[xid],
+                            program, version)
         try:
             if self.debug: print "send %i" % xid
-            self.socket.send_record(header + data)
+            sock = self.socket
+            if self.capture is not None:
+                self.capture.record(connection_id(sock), header + data)
+            sock.send_record([header, data], self.fragsize)
         except socket.timeout:
+            # Part of the record may have gone, so the stream is unusable
+            self._release_socket(discard=True)
             raise
         except socket.error, e:
             print "Got error:", e
             if self.debug: print "resend", xid
-            try:
-                self.reconnect().send_record(header + data)
-            except socket.error:
-                self.reconnect()
-                raise
-        self.add_outstanding_xids(xid, header, data, cred, procedure)
+            self.replay(e, time.time() + self.timeout)
         return xid
 
-    def listen(self, xid):
-        # Exists (per thread) list of outstanding xid/seq pairs
-        # If xid not on list, return error.
-        # Listen until get reply with given xid.  Cache others received
-        # on list.  Return error if get one not on list.
+    def send_many(self, calls, program=None, version=None):
+        """Send a batch of RPC calls with a single write
+
+        calls is a list of (procedure, packed arguments) pairs.
+        Returns the list of xids, for listen.
+        """
+        if program is None: program = self.default_prog
+        if version is None: version = self.default_vers
+        if program is None or version is None:
+            raise RPCError("Bad program/version: %s/%s" % (program, version))
+        xids = []
+        records = []
+        for procedure, data in calls:
+            xid = self.get_new_xid()
+            header, cred = self.get_call_header(xid, program, version,
+                                                procedure)
+            data = self.security.secure_data(data, cred)
+            self.add_outstanding_xids(xid, header, data, cred, procedure)
+            if self.metrics is not None:
+                self.start_call(self.get_outstanding_xids()[xid],
+                                program, version)
+            xids.append(xid)
+            records.append([header, data])
+        try:
+            if self.debug: print "send %s" % xids
+            sock = self.socket
+            if self.capture is not None:
+                for header, data in records:
+                    self.capture.record(connection_id(sock), header + data)
+            sock.send_records(records, self.fragsize)
+        except socket.timeout:
+            self._release_socket(discard=True)
+            raise
+        except socket.error, e:
+            print "Got error:", e
+            if self.debug: print "resend", xids
+            self.replay(e, time.time() + self.timeout)
+        return xids
+
+    def start_call(self, cache, program, version):
+        """Note the time a call is sent, for metrics"""
+        cache.key = (program, version, cache.proc)
+        cache.start = time.time()
+
+    def count_call(self, cache, error=False):
+        """Record a finished call in metrics"""
+        if cache.start is None:
+            # Sent before metrics were enabled
+            return
+        self.metrics.record(cache.key, time.time() - cache.start,
+                            cache.rsize, len(cache.header) + len(cache.data),
+                            error)
+
+    def replay(self, error, deadline, count=0):
+        """Reconnect, and send again every call awaiting a reply
+
+        count is the number of reconnects the current call has already
+        made.  Once it reaches reconnects, or the deadline passes, error
+        (the last socket error seen) is raised.  Returns the new count.
+        """
+        list = self.get_outstanding_xids()
+        while 1:
+            if count >= self.reconnects or time.time() >= deadline:
+                self._release_socket(discard=True)
+                raise error
+            if count:
+                time.sleep(min(self.timeo * self.backoff ** count,
+                               max(0, deadline - time.time())))
+            count += 1
+            try:
+                s = self.reconnect()
+                for cache in list.values():
+                    if cache.rhead is None:
+                        s.send_record([cache.header, cache.data],
+                                      self.fragsize)
+                return count
+            except socket.error, e:
+                print "Got error:", e
+                error = e
+
+    def listen(self, xid, timeout=None):
+        """Wait for the reply to xid and return its packed results
+
+        Replies to this thread's other outstanding calls are cached for
+        their own listen.  timeout overrides the client's for this call.
+        """
         if self.debug: print "listen", xid
         list = self.get_outstanding_xids()
         if xid not in list:
             raise
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        # Retransmission can give stale or repeated replies
+        lenient = self.proto == 'udp' or self.retrans
         done = False
+        tries = reconnects = 0
         rdata = list[xid].rdata
         if rdata is not None:
             rhead = list[xid].rhead
             done = True
         while not done:
+            left = deadline - time.time()
+            if tries < self.retrans:
+                wait = min(self.timeo * self.backoff ** tries, left)
+            else:
+                wait = left
+            sock = self.socket
             try:
-                reply = self.socket.recv_record()
-            except socket.timeout:
-                raise
+                if wait <= 0:
+                    raise socket.timeout("timed out")
+                sock.settimeout(wait)
+                try:
+                    reply = sock.recv_record()
+                finally:
+                    sock.settimeout(self.timeout)
+            except socket.timeout, e:
+                if tries >= self.retrans or wait >= left:
+                    if self.metrics is not None:
+                        self.count_call(list[xid], error=True)
+                    # A late reply must not reach the next user
+                    self._release_socket(discard=True)
+                    raise
+                # Keep the connection even if a reply was cut short, as
+                # the next recv_record carries on where this one stopped
+                tries += 1
+                if self.debug: print "retransmit", xid
+                try:
+                    sock.send_record([list[xid].header, list[xid].data],
+                                     self.fragsize)
+                except socket.timeout:
+                    self._release_socket(discard=True)
+                    raise
+                except socket.error, e:
+                    print "Got error:", e
+                    reconnects = self.replay(e, deadline, reconnects)
+                continue
             except socket.error, e:
                 print "Got error:", e
                 if self.debug: print "relisten", xid
-                try:
-                    s = self.reconnect()
-                    s.send_record(list[xid].header + list[xid].data)
-                    reply = s.recv_record()
-                except socket.error:
-                    self.reconnect()
-                    raise
-            p = self.getrpcunpacker()
-            p.reset(reply)
-            rhead = p.unpack_rpc_msg()
+                reconnects = self.replay(e, deadline, reconnects)
+                continue
+            rhead, pos = self.unpack_reply(reply)
             rxid = rhead.xid
+            if lenient and \
+                   (rxid not in list or list[rxid].rhead is not None):
+                continue
             if rxid not in list:
                 raise RPCError("Got reply xid %i, expected %i" % \
                                (rxid, xid))
             if list[rxid].rhead is not None:
                 raise RPCError("Duplicated reply xid %i" % rxid)
-            rdata = reply[p.get_position():]
+            rdata = reply[pos:]
             try:
                 # BUG?, should use rhead credentials?
                 # This conditional is gss specific code that should be hidden
@@ -416,21 +1653,60 @@ class RPCClient(object):
                     raise
             list[rxid].rhead = rhead
             list[rxid].rdata = rdata
+            list[rxid].rsize = len(reply)
             if rxid == xid:
                 done = True
         out = list[xid]
         del list[xid]
-        self.check_reply(out)
+        if not list:
+            self._release_socket()
+        if self.metrics is None:
+            self.check_reply(out)
+            return rdata
+        try:
+            self.check_reply(out)
+        except:
+            self.count_call(out, error=True)
+            raise
+        self.count_call(out)
         return rdata
 
-    def call(self, procedure, data='', program=None, version=None):
+    def call(self, procedure, data='', program=None, version=None,
+             timeout=None):
         """Make an RPC call to the server
 
         Takes as input packed arguments
         Returns packed results
+        timeout overrides the client's for this call
         """
         xid = self.send(procedure, data, program, version)
-        return self.listen(xid)
+        return self.listen(xid, timeout)
+
+    def call_many(self, calls, program=None, version=None, timeout=None):
+        """Make a batch of RPC calls, sending them all at once
+
+        calls is a list of (procedure, packed arguments) pairs.  Returns
+        the list of packed results in the same order, however the replies
+        arrive.  timeout applies to the batch as a whole.  If any call
+        fails with an RPCError, the first is raised once all the replies
+        are in.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        xids = self.send_many(calls, program, version)
+        results = []
+        error = None
+        for xid in xids:
+            try:
+                results.append(self.listen(xid, deadline - time.time()))
+            except RPCError, e:
+                if error is None:
+                    error = e
+                results.append(None)
+        if error is not None:
+            raise error
+        return results
 
     def get_new_xid(self): # Thread safe
         self.lock.acquire()
@@ -444,9 +1720,16 @@ class RPCClient(object):
     # Because some security flavors use partial packing info to determine
     # verf, can't call packer.pack_rpc_msg.
     def get_call_header(self, xid, prog, vers, proc): # THREAD SAFE
+        cred = self.security.make_cred()
+        if self.security.fixed_header:
+            # Everything after the xid is the same for each call, so reuse
+            # it until the credential changes
+            key = (prog, vers, proc, self.security, cred.flavor, cred.body)
+            tail = self._headers.get(key)
+            if tail is not None:
+                return _xid_struct.pack(xid) + tail, cred
         p = self.getrpcpacker()
         p.reset()
-        cred = self.security.make_cred()
         p.pack_uint(xid)
         p.pack_enum(CALL)
 	p.pack_uint(RPCVERSION)
@@ -456,7 +1739,26 @@ class RPCClient(object):
 	p.pack_opaque_auth(cred)
         verf = self.security.make_verf(p.get_buffer())
         p.pack_opaque_auth(verf)
-        return p.get_buffer(), cred
+        header = p.get_buffer()
+        if self.security.fixed_header:
+            if len(self._headers) >= 1024:
+                self._headers.clear()
+            self._headers[key] = header[4:]
+        return header, cred
+
+    def unpack_reply(self, reply, p=None):
+        """Return the rpc_msg header of a reply and the offset of its results
+
+        The usual accepted SUCCESS reply is decoded by unpack_reply_header,
+        anything else with unpacker p, by default this thread's.
+        """
+        out = unpack_reply_header(reply)
+        if out is None:
+            if p is None:
+                p = self.getrpcunpacker()
+            p.reset(reply)
+            out = p.unpack_rpc_msg(), p.get_position()
+        return out
 
     def check_reply(self, cache_data): # THREAD SAFE
         """Looks at rpc_msg reply and raises error if necessary
@@ -475,29 +1777,496 @@ class RPCClient(object):
         #STUB
         self.security.check_verf(msg.areply.verf, cache_data.cred)
             
+class AsyncCall(Deferred):
+    """Deferred for the reply to an AsyncRPCClient call
+
+    If wait times out, the client forgets the call, and a late reply to
+    it is dropped.
+    """
+    def __init__(self, client, xid):
+        Deferred.__init__(self)
+        self.client = client
+        self.xid = xid
+
+    def wait(self, timeout=None):
+        try:
+            return Deferred.wait(self, timeout)
+        except socket.timeout:
+            self.client.forget(self.xid)
+            raise
+
+class AsyncRPCClient(RPCClient):
+    """RPCClient that keeps many calls in flight on a single connection
+
+    call_async() returns an AsyncCall for the reply data, so one thread can
+    issue many calls before waiting for any of them.  A reader thread
+    matches replies to calls by xid.  send, listen and call behave as
+    for RPCClient, except that calls are never retransmitted, so only
+    TCP is supported.
+    """
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("proto", "tcp") != "tcp":
+            raise RPCError("AsyncRPCClient does not retransmit, "
+                           "so only supports TCP")
+        self._async_socket = None
+        self._send_lock = threading.Lock()
+        self._calls = {}   # xid -> (Deferred, XidCache, socket), until reply
+        self._waiting = {} # xid -> Deferred, for send/listen
+        RPCClient.__init__(self, *args, **kwargs)
+
+    def getsocket(self):
+        self.lock.acquire()
+        try:
+            if self._async_socket is None:
+                out = self._async_socket = self.connect()
+                # Per call timeouts are applied in Deferred.wait instead
+                out.settimeout(None)
+                t = threading.Thread(target=self._reader, args=(out,),
+                                     name="rpc reader %s" %
+                                     connection_id(out))
+                t.setDaemon(True)
+                t.start()
+            out = self._async_socket
+        finally:
+            self.lock.release()
+        return out
+
+    socket = property(getsocket)
+
+    def call_async(self, procedure, data='', program=None, version=None):
+        """Send an RPC call, returning an AsyncCall for the packed results
+
+        If the call fails, the AsyncCall's result is the exception.
+        """
+        if program is None: program = self.default_prog
+        if version is None: version = self.default_vers
+        if program is None or version is None:
+            raise RPCError("Bad program/version: %s/%s" % (program, version))
+        xid = self.get_new_xid()
+        header, cred = self.get_call_header(xid, program, version, procedure)
+        data = self.security.secure_data(data, cred)
+        d = AsyncCall(self, xid)
+        sock = self.socket
+        cache = self.XidCache(header, data, cred, procedure)
+        if self.metrics is not None:
+            self.start_call(cache, program, version)
+        self.lock.acquire()
+        self._calls[xid] = (d, cache, sock)
+        self.lock.release()
+        if self.debug: print "send %i" % xid
+        if self.capture is not None:
+            self.capture.record(connection_id(sock), header + data)
+        self._send_lock.acquire()
+        try:
+            try:
+                sock.send_record([header, data], self.fragsize)
+            except socket.error:
+                self.lock.acquire()
+                self._calls.pop(xid, None)
+                self.lock.release()
+                self._disconnect(sock)
+                raise
+        finally:
+            self._send_lock.release()
+        return d
+
+    def send(self, procedure, data='', program=None, version=None):
+        d = self.call_async(procedure, data, program, version)
+        self.lock.acquire()
+        self._waiting[d.xid] = d
+        self.lock.release()
+        return d.xid
+
+    def send_many(self, calls, program=None, version=None):
+        if program is None: program = self.default_prog
+        if version is None: version = self.default_vers
+        if program is None or version is None:
+            raise RPCError("Bad program/version: %s/%s" % (program, version))
+        sock = self.socket
+        xids = []
+        records = []
+        for procedure, data in calls:
+            xid = self.get_new_xid()
+            header, cred = self.get_call_header(xid, program, version,
+                                                procedure)
+            data = self.security.secure_data(data, cred)
+            d = AsyncCall(self, xid)
+            cache = self.XidCache(header, data, cred, procedure)
+            if self.metrics is not None:
+                self.start_call(cache, program, version)
+            self.lock.acquire()
+            self._calls[xid] = (d, cache, sock)
+            self._waiting[xid] = d
+            self.lock.release()
+            xids.append(xid)
+            records.append([header, data])
+        if self.debug: print "send %s" % xids
+        if self.capture is not None:
+            for header, data in records:
+                self.capture.record(connection_id(sock), header + data)
+        self._send_lock.acquire()
+        try:
+            try:
+                sock.send_records(records, self.fragsize)
+            except socket.error:
+                self.lock.acquire()
+                for xid in xids:
+                    self._calls.pop(xid, None)
+                    self._waiting.pop(xid, None)
+                self.lock.release()
+                self._disconnect(sock)
+                raise
+        finally:
+            self._send_lock.release()
+        return xids
+
+    def listen(self, xid, timeout=None):
+        if self.debug: print "listen", xid
+        self.lock.acquire()
+        d = self._waiting.pop(xid, None)
+        self.lock.release()
+        if d is None:
+            raise RPCError("Listening for unknown xid %i" % xid)
+        if timeout is None:
+            timeout = self.timeout
+        return d.wait(timeout)
+
+    def forget(self, xid):
+        """Stop waiting for the reply to xid"""
+        self.lock.acquire()
+        self._calls.pop(xid, None)
+        self._waiting.pop(xid, None)
+        self.lock.release()
+
+    def reconnect(self):
+        self._disconnect(self._async_socket)
+        return self.socket
+
+    def _disconnect(self, sock):
+        self.lock.acquire()
+        if self._async_socket is sock:
+            self._async_socket = None
+        self.lock.release()
+        if sock is not None:
+            sock.close()
+
+    def _reader(self, sock):
+        try:
+            self._read_replies(sock)
+        finally:
+            # Connection is gone, so fail everything still outstanding
+            self._disconnect(sock)
+            self.lock.acquire()
+            lost = [xid for xid, call in self._calls.items()
+                    if call[2] is sock]
+            lost = [self._calls.pop(xid)[0] for xid in lost]
+            self.lock.release()
+            for d in lost:
+                d.callback(socket.error("Connection closed"))
+
+    def _read_replies(self, sock):
+        p = rpc_pack.RPCUnpacker('')
+        while 1:
+            try:
+                reply = sock.recv_record()
+            except socket.error, e:
+                return
+            try:
+                rhead, pos = self.unpack_reply(reply, p)
+            except Exception, e:
+                # xdrlib raises EOFError, among others, for short replies
+                print "Bad reply header:", e
+                continue
+            self.lock.acquire()
+            d, cache, s = self._calls.pop(rhead.xid, (None, None, None))
+            self.lock.release()
+            if d is None:
+                print "Got reply for unexpected xid %i" % rhead.xid
+                continue
+            cache.rhead = rhead
+            cache.rsize = len(reply)
+            try:
+                rdata = reply[pos:]
+                if rhead.rbody.stat == MSG_ACCEPTED and \
+                        rhead.areply.reply_data.stat == SUCCESS:
+                    rdata = self.security.unsecure_data(rdata, cache.cred)
+                self.check_reply(cache)
+            except Exception, e:
+                if self.metrics is not None:
+                    self.count_call(cache, error=True)
+                d.callback(e)
+            else:
+                if self.metrics is not None:
+                    self.count_call(cache)
+                d.callback(rdata)
+
 ###################################################
 
 class Server(object):
-    def __init__(self, host='', port=51423, name="SERVER",ipv6=False):
-        if ipv6:
-            self.s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    """Event loop for a listening socket and its connections
+
+    engine chooses the polling mechanism: 'epoll' (edge-triggered),
+    'epoll-lt' (level-triggered) or 'poll'.  backlog is passed to listen,
+    and nodelay, sndbuf and rcvbuf set TCP_NODELAY, SO_SNDBUF and SO_RCVBUF
+    on each accepted connection.
+
+    If udp is set, datagrams of up to udpsize bytes are also accepted on
+    the same port, and passed to event_datagram.
+
+    A host of the form 'unix:/path' listens on a Unix socket at /path
+    instead, replacing any stale socket left there.  port is then ignored
+    and set to None.
+
+    At most maxconns connections are kept open.  When another arrives,
+    the least recently active idle connection is closed to make room, or
+    if none is idle the new one is refused.  Connections idle for
+    idletimeout seconds are closed.  A connection is idle unless busy()
+    says otherwise; see connection_stats for the counts kept.
+    """
+    def __init__(self, host='', port=51423, name="SERVER", ipv6=False,
+                 engine=None, backlog=5, nodelay=False,
+                 sndbuf=None, rcvbuf=None, recvsize=65536, reuseport=False,
+                 udp=False, udpsize=65507, maxconns=None, idletimeout=None):
+        self.host = host
+        self.ipv6 = ipv6
+        self.reuseport = reuseport
+        self.unixpath = unix_path(host)
+        if self.unixpath is not None:
+            if udp:
+                raise RPCError("Unix socket transport is stream only")
+            if reuseport:
+                raise RPCError("Unix sockets can not be shared by reuseport")
+        self.s = self.bind(port)
+        if self.unixpath is not None:
+            self.port = None
+        else:
+            self.port = self.s.getsockname()[1]
+        self.udpsize = udpsize
+        if udp:
+            self.u = self.bind(self.port, socket.SOCK_DGRAM)
         else:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.s.bind((host, port))
-        self.port = self.s.getsockname()[1]
-        self.s.setblocking(0)
+            self.u = None
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.recvsize = recvsize
+        if engine is None:
+            engine = _default_engine
+        if engine not in _engines:
+            raise ValueError("Unknown poll engine %r" % engine)
+        self.engine = engine
+        self._calls = []
+        self._calls_lock = threading.Lock()
+        self.maxconns = maxconns
+        self.idletimeout = idletimeout
+        # Connection fd -> time of last activity, least recent first
+        self.lastactive = OrderedDict()
+        self.accepted = 0
+        self.refused = 0
+        self.evicted = 0
+        self.idleclosed = 0
+        # fds closed while handling the current batch of events
+        self.closed = set()
+        self.loopthread = None # thread in run(), if any
+        self.init_poll()
+        self.name = name
+
+    def bind(self, port, type=socket.SOCK_STREAM):
+        """Return a new nonblocking socket bound to port"""
+        if self.unixpath is not None:
+            return self.bind_unix(self.unixpath)
+        if self.ipv6:
+            s = socket.socket(socket.AF_INET6, type)
+        else:
+            s = socket.socket(socket.AF_INET, type)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            if SO_REUSEPORT is None:
+                raise RPCError("SO_REUSEPORT is not supported by this python")
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind((self.host, port))
+        s.setblocking(0)
+        return s
+
+    def bind_unix(self, path):
+        """Return a new nonblocking Unix socket bound to path"""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        s.bind(path)
+        s.setblocking(0)
+        return s
+
+    def init_poll(self):
         # Set up poll object
-        self.p = select.poll()
+        self.p = _engines[self.engine]()
+        self.edge = getattr(self.p, "edge", False)
         self.p.register(self.s, _readmask)
-        self.name = name
+        if self.u is not None:
+            self.p.register(self.u, _readmask)
+        # Pipe used by other threads to wake up the poll loop
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.p.register(self._wakeup_r, _readmask)
+
+    def setup_socket(self, sock):
+        """Apply configured socket options to an accepted connection"""
+        if self.nodelay and self.unixpath is None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def write_pending(self, fd):
+        """Return True if fd still has output queued"""
+        return False
+
+    def read_paused(self, fd):
+        """Return True if no more should be read from fd for now"""
+        return False
+
+    def busy(self, fd):
+        """Return True if fd has work in progress, so is not idle"""
+        return False
+
+    def run_ready(self):
+        """Do work held over from earlier passes of the poll loop
+
+        Returns True if some is still left, so poll should not wait.
+        """
+        return False
+
+    def connection_opened(self, fd):
+        """Start tracking a new connection, enforcing maxconns"""
+        self.accepted += 1
+        if self.maxconns is not None and \
+               len(self.lastactive) >= self.maxconns:
+            for old in self.lastactive:
+                if not self.busy(old):
+                    self.evicted += 1
+                    self.event_close(old)
+                    break
+            else:
+                self.refused += 1
+                self.lastactive[fd] = time.time()
+                self.event_close(fd)
+                return
+        self.lastactive[fd] = time.time()
+
+    def connection_closed(self, fd):
+        self.lastactive.pop(fd, None)
+        self.closed.add(fd)
+
+    def touch(self, fd):
+        """Note activity on a connection"""
+        if fd in self.lastactive:
+            del self.lastactive[fd]
+            self.lastactive[fd] = time.time()
+
+    def close_idle(self):
+        """Close connections idle too long, and return the poll timeout
+
+        The timeout, in milliseconds, is when the next one would be due.
+        """
+        if self.idletimeout is None:
+            return None
+        now = time.time()
+        limit = now - self.idletimeout
+        for fd, last in self.lastactive.items():
+            if self.busy(fd):
+                continue
+            if last > limit:
+                return int((last - limit) * 1000) + 1
+            self.idleclosed += 1
+            self.event_close(fd)
+        return None
+
+    def connection_stats(self):
+        return {"open" : len(self.lastactive),
+                "accepted" : self.accepted,
+                "refused" : self.refused,
+                "evicted" : self.evicted,
+                "idleclosed" : self.idleclosed}
+
+    def update_poll(self, fd):
+        """Register fd for the events it currently needs"""
+        mask = _stdmask
+        if not self.read_paused(fd):
+            mask |= _readmask
+        if self.write_pending(fd):
+            mask |= _writemask
+        self.p.register(fd, mask)
+
+    def call_soon(self, func, *args):
+        """Arrange for func(*args) to be called from the poll loop
+
+        This is safe to call from any thread.
+        """
+        self._calls_lock.acquire()
+        try:
+            wake = not self._calls
+            self._calls.append((func, args))
+        finally:
+            self._calls_lock.release()
+        if wake:
+            try:
+                os.write(self._wakeup_w, 'x')
+            except OSError, e:
+                if e.errno not in _blocking:
+                    raise
+
+    def run_calls(self):
+        """Run everything queued by call_soon"""
+        # Drain the pipe before taking the list, so a wakeup is never lost
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in _blocking:
+                raise
+        self._calls_lock.acquire()
+        calls = self._calls
+        self._calls = []
+        self._calls_lock.release()
+        for func, args in calls:
+            func(*args)
 
     def run(self, debug=0):
+        self.loopthread = threading.currentThread()
+        try:
+            self.loop(debug)
+        finally:
+            self.loopthread = None
+
+    def loop(self, debug=0):
         while 1:
             if debug: print "%s: Calling poll" % self.name
-            res = self.p.poll()
+            timeout = self.close_idle()
+            if self.run_ready():
+                timeout = 0
+            try:
+                res = self.p.poll(timeout)
+            except (select.error, IOError), e:
+                # A signal handler ran, e.g. to dump metrics
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
             if debug: print "%s: %s" % (self.name, res)
+            self.closed.clear()
             for fd, event in res:
+                if fd in self.closed:
+                    # Closed, maybe even reused, by an earlier event
+                    if debug:
+                        print "%s: Skipping closed fd=%i" % (self.name, fd)
+                    continue
                 if debug:
                     print "%s: Handling fd=%i, event=%x" % \
                           (self.name, fd, event)
@@ -512,23 +2281,224 @@ class Server(object):
                     self.event_error(fd)
                 else:
                     if event & select.POLLOUT:
-                        self.event_write(fd)
+                        self.handle_write(fd, debug)
                     # This must be last since may call close
                     if event & select.POLLIN:
                         if fd == self.s.fileno():
-                            self.event_connect(fd,debug)
+                            self.handle_connect(fd, debug)
+                        elif fd == self._wakeup_r:
+                            self.run_calls()
+                        elif self.u is not None and fd == self.u.fileno():
+                            self.handle_datagrams(debug)
                         else:
-                            data = self.sockets[fd].recv(4096)
-                            if data:
-                                self.event_read(fd, data, debug)
-                            else:
-                                self.event_close(fd)
+                            self.handle_read(fd, debug)
+
+    def run_forked(self, count, debug=0):
+        """Serve from count processes, each running its own poll loop
+
+        The server must have been created with reuseport set.  Each child
+        binds its own listening socket to the same port, and the kernel
+        spreads new connections across them.  This process serves as one
+        of the count, and kills the others when its loop exits.  Since
+        nothing is shared between processes, this only suits stateless
+        programs.
+        """
+        if not self.reuseport:
+            raise RPCError("run_forked requires reuseport")
+        pids = []
+        # Make sure SIGTERM unwinds through the cleanup below
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        old_handler = signal.signal(signal.SIGTERM, terminate)
+        try:
+            for i in range(count - 1):
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        self.init_child()
+                        self.run(debug)
+                    except KeyboardInterrupt:
+                        pass
+                    except:
+                        # Don't hide a crash behind a clean exit
+                        traceback.print_exc()
+                        status = 1
+                    finally:
+                        os._exit(status)
+                pids.append(pid)
+            self.run(debug)
+        finally:
+            signal.signal(signal.SIGTERM, old_handler)
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def init_child(self):
+        """Give a freshly forked worker its own socket and poll loop"""
+        old = self.s
+        self.s = self.bind(self.port)
+        self.s.listen(self.backlog)
+        old.close()
+        if self.u is not None:
+            old = self.u
+            self.u = self.bind(self.port, socket.SOCK_DGRAM)
+            old.close()
+        # The parent's poll object and wakeup pipe must not be shared
+        if hasattr(self.p, "close"):
+            self.p.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._calls = []
+        self._calls_lock = threading.Lock()
+        self.init_poll()
+
+    # With an edge-triggered engine we are told about readiness only once,
+    # so the handle_* methods below keep going until the socket would block.
+
+    def handle_connect(self, fd, debug=0):
+        while 1:
+            try:
+                self.event_connect(fd, debug)
+            except socket.error, e:
+                if e[0] in _blocking:
+                    return
+                raise
+            if not self.edge:
+                return
+
+    def handle_read(self, fd, debug=0):
+        self.touch(fd)
+        while fd in self.sockets and not self.read_paused(fd):
+            try:
+                data = self.sockets[fd].recv(self.recvsize)
+            except socket.error, e:
+                if e[0] in _blocking:
+                    return
+                self.event_error(fd)
+                return
+            if data:
+                self.event_read(fd, data, debug)
+            else:
+                self.event_close(fd)
+                return
+            if not self.edge:
+                return
+
+    def handle_datagrams(self, debug=0):
+        while 1:
+            try:
+                # Ask for an extra byte, to notice oversized datagrams
+                data, addr = self.u.recvfrom(self.udpsize + 1)
+            except socket.error, e:
+                if e[0] in _blocking:
+                    return
+                raise
+            if len(data) > self.udpsize:
+                print "%s: dropping %i byte datagram from %s" % \
+                      (self.name, len(data), addr)
+            else:
+                self.event_datagram(data, addr, debug)
+            if not self.edge:
+                return
+
+    def event_datagram(self, data, addr, debug=0):
+        pass
+
+    def send_datagram(self, addr, data):
+        """Send data (a string or list of strings, or None for none) to addr
+
+        Datagrams too large to send are dropped.
+        """
+        if data is None:
+            return
+        if not isinstance(data, str):
+            data = ''.join([isinstance(b, memoryview) and b.tobytes() or b
+                            for b in data])
+        if len(data) > self.udpsize:
+            print "%s: dropping %i byte reply to %s" % \
+                  (self.name, len(data), addr)
+            return
+        try:
+            self.u.sendto(data, addr)
+        except socket.error, e:
+            # Like the network, drop datagrams we can't send
+            if e[0] not in _blocking:
+                print "%s: sendto %s failed: %s" % (self.name, addr, e)
+
+    def handle_write(self, fd, debug=0):
+        self.touch(fd)
+        try:
+            self.event_write(fd)
+            if not self.edge:
+                return
+            while fd in self.sockets and self.write_pending(fd):
+                self.event_write(fd)
+        except socket.error, e:
+            if e[0] in _blocking:
+                return
+            self.event_error(fd)
+            return
+        if fd in self.sockets:
+            # Nothing left, let event_write drop interest in POLLOUT
+            self.event_write(fd)
 
 class RPCServer(Server):
-    def __init__(self, prog=10, vers=4, host='', port=51423,ipv6=False):
-        Server.__init__(self, host, port, ipv6)
-        self.rpcpacker =  rpc_pack.RPCPacker()
-        self.rpcunpacker = rpc_pack.RPCUnpacker('')
+    """Server for a single RPC program and version
+
+    If workers is nonzero, calls are decoded and executed by a pool of that
+    many threads instead of on the poll loop, so handlers must be thread
+    safe.  If ordered is also set, calls from any one connection are run
+    one at a time in the order received.
+
+    Connections sending a call record longer than maxrecord bytes are
+    closed.  Replies are sent as a single record fragment, unless fragsize
+    is set.
+
+    If drcsize is nonzero, replies to calls of the procedures in drcprocs
+    (by default all but NULL) are kept in a duplicate request cache of
+    that many bytes, and retransmissions are answered from it instead of
+    being executed again.  Calls are told apart by the client's full
+    address, port included, so a call resent on a new connection is only
+    taken for a retransmission if it comes from the same port (as
+    RPCClient arranges when it reconnects).
+
+    Replies waiting to be sent are limited to maxoutput bytes on any one
+    connection, and maxoutputtotal bytes in all.  While a connection is
+    over its limit, or the server over its total, no more calls are read
+    from it, until the output drops to half the limit (see output_stats).
+    With workers, a connection then also has no more calls in progress
+    at once than there are workers, so that replies still to come can
+    not overshoot the limits by more than that.
+
+    If batch is set, connections take turns: each pass of the poll loop
+    handles at most batch calls from each connection, so a client
+    pipelining many calls can not hold up the others.  weights maps client
+    hosts to how many batches they get per turn (by default 1); override
+    weight() for other policies.
+
+    If classifier is set, calls are sorted into priority classes by its
+    classify method (see CallClassifier), and queued ahead of compute_reply
+    so that more urgent classes run first: from the worker pool as soon
+    as a worker is free, otherwise one between each poll.  Queue
+    depths and waits are kept for each class, see class_stats.  This can
+    not be combined with ordered.
+
+    If metrics is a Metrics instance, every call is counted in it, and
+    SIGUSR1 writes it as JSON to metricsfile (or stdout).  If capture is
+    a Capture, every call record received over TCP is appended to it.
+    """
+    def __init__(self, prog=10, vers=4, host='', port=51423, ipv6=False,
+                 workers=0, ordered=False, maxrecord=None, fragsize=None,
+                 drcsize=0, drcprocs=None, metrics=None, metricsfile=None,
+                 capture=None, maxoutput=None, maxoutputtotal=None,
+                 batch=None, weights=None, classifier=None, **kwargs):
+        Server.__init__(self, host, port, ipv6=ipv6, **kwargs)
+        self._local = threading.local()
         self.prog = prog
         self.vers = vers # FRED - this could be more general
         self.security = {AUTH_NONE: SecAuthNone(),
@@ -536,12 +2506,123 @@ class RPCServer(Server):
                          }
         if 'gss' in supported:
             self.security[RPCSEC_GSS] = SecAuthGss()
-        self.readbufs = {}
-        self.writebufs = {}
-        self.packetbufs = {} # store packets read until have a whole record
-        self.recordbufs = {} # write buffer for outgoing records
+        self.maxrecord = maxrecord
+        self.readers = {} # reassemble incoming records
+        self.inrecords = {} # records received but not yet handled
+        self.inflight = {}  # calls being worked on for each connection
+        self.writebufs = {}  # buffers of the record being sent
+        self.recordbufs = {} # outgoing records waiting to be sent
+        self.fragsize = fragsize
         self.sockets = {}
-        self.s.listen(5)
+        self.peers = {} # client host of each connection
+        self.addrs = {} # client address of each connection, for the drc
+        if drcsize:
+            self.drc = ReplyCache(drcsize)
+        else:
+            self.drc = None
+        self.drcprocs = drcprocs
+        self.ordered = ordered
+        self.queuedcalls = {} # calls waiting for an ordered connection
+        if workers:
+            self.pool = WorkerPool(workers)
+        else:
+            self.pool = None
+        self.metrics = metrics
+        self.metricsfile = metricsfile
+        self.capture = capture
+        self.maxoutput = maxoutput
+        self.maxoutputtotal = maxoutputtotal
+        # Calls in progress on a connection before reading from it pauses
+        self.maxinflight = None
+        if workers and (maxoutput is not None or maxoutputtotal is not None):
+            self.maxinflight = workers
+        self.outbytes = {}      # output bytes queued on each connection
+        self.outtotal = 0
+        self.stalled = set()    # connections over maxoutput
+        self.globalstall = False
+        self.stalls = 0
+        self.globalstalls = 0
+        self.batch = batch
+        self.weights = weights or {}
+        self.ready = OrderedDict() # connections waiting for their turn
+        if classifier is not None and ordered:
+            raise RPCError("classifier can not be combined with ordered")
+        self.classifier = classifier
+        self.classqueues = {} # class -> deque of calls waiting to start
+        self.classinfo = {}   # class -> statistics, see class_stats
+        self.running = 0      # calls handed to the worker pool
+        # Held by a LoopbackSocket computing a reply in place of the loop
+        self._loopback_lock = threading.Lock()
+        self.dumpwanted = False
+        if metrics is not None:
+            try:
+                signal.signal(signal.SIGUSR1, self.request_dump)
+            except ValueError:
+                # Signal handlers can only be set from the main thread
+                pass
+        self.s.listen(self.backlog)
+
+    # Each worker thread needs its own rpc packer and unpacker
+
+    def _get_rpcpacker(self):
+        try:
+            return self._local.rpcpacker
+        except AttributeError:
+            out = self._local.rpcpacker = rpc_pack.RPCPacker()
+            return out
+
+    def _get_rpcunpacker(self):
+        try:
+            return self._local.rpcunpacker
+        except AttributeError:
+            out = self._local.rpcunpacker = rpc_pack.RPCUnpacker('')
+            return out
+
+    rpcpacker = property(_get_rpcpacker)
+    rpcunpacker = property(_get_rpcunpacker)
+
+    def request_dump(self, signum, frame):
+        """SIGUSR1 handler, asking the poll loop to call dump_metrics
+
+        The dump can not be done here, since the signal may have arrived
+        while this thread holds a lock the dump needs, so just set a flag
+        and wake up the loop.
+        """
+        self.dumpwanted = True
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, e:
+            if e.errno not in _blocking:
+                raise
+
+    def run_calls(self):
+        Server.run_calls(self)
+        if self.dumpwanted:
+            self.dumpwanted = False
+            self.dump_metrics()
+
+    def dump_metrics(self):
+        """Write metrics as JSON to metricsfile, or stdout
+
+        metricsfile is replaced by renaming, so is never seen half written.
+        """
+        if self.metricsfile is None:
+            print self.metrics.to_json()
+            sys.stdout.flush()
+            return
+        tmpfile = self.metricsfile + ".tmp"
+        fd = open(tmpfile, "w")
+        try:
+            fd.write(self.metrics.to_json() + "\n")
+        finally:
+            fd.close()
+        os.rename(tmpfile, self.metricsfile)
+
+    def count_call(self, call, start, recv_data, reply, error):
+        """Record a finished call in metrics"""
+        size = sum([len(piece) for piece in reply])
+        self.metrics.record((call.prog, call.vers, call.proc),
+                            time.time() - start, len(recv_data), size, error)
 
     def handle_0(self, data, cred):
         if data != '':
@@ -552,17 +2633,31 @@ class RPCServer(Server):
     def event_connect(self, fd, debug=0):
         csock, caddr = self.s.accept()
         csock.setblocking(0)
+        self.setup_socket(csock)
         if debug:
             print "SERVER: got connection from %s, " \
                   "assigned to fd=%i" % \
                   (csock.getpeername(), csock.fileno())
         self.p.register(csock, _readmask)
         cfd = csock.fileno()
-        self.readbufs[cfd] = ''
-        self.writebufs[cfd] = ''
-        self.packetbufs[cfd] = []
-        self.recordbufs[cfd] = []
+        if self.unixpath is not None:
+            # Unix socket clients are usually unnamed, and then can only
+            # be told apart by their connection
+            self.peers[cfd] = caddr or self.host
+            self.addrs[cfd] = caddr or cfd
+        else:
+            self.peers[cfd] = caddr[0]
+            self.addrs[cfd] = caddr
+        self.readers[cfd] = RecordReader(self.maxrecord)
+        self.writebufs[cfd] = deque()
+        self.recordbufs[cfd] = deque()
+        self.inrecords[cfd] = deque()
+        self.outbytes[cfd] = 0
+        self.inflight[cfd] = 0
         self.sockets[cfd] = csock
+        if self.globalstall:
+            self.update_poll(cfd)
+        self.connection_opened(cfd)
         
     def event_read(self, fd, data, debug=0):
         """Reads incoming record marked packets
@@ -570,58 +2665,356 @@ class RPCServer(Server):
         Also responds to command codes sent as encoded integers
         """
         if debug: print "SERVER: In read event for %i" % fd
-        self.readbufs[fd] += data
-        loop = True
-        while loop:
-            loop = False
-            str = self.readbufs[fd]
-            if len(str) >= 4:
-                packetlen = struct.unpack('>I', str[0:4])[0]
-                last = 0x80000000L & packetlen
-                packetlen &= 0x7fffffffL
-                if len(str) >= 4 + packetlen:
-                    self.packetbufs[fd].append(str[4:4 + packetlen])
-                    self.readbufs[fd] = str[4 + packetlen:]
-                    if self.readbufs[fd]:
-                        loop = True # We've received data past last 
-                    if last:
-                        if debug: print "SERVER: Received record from %i" % fd
-                        recv_data = ''.join(self.packetbufs[fd])
-                        self.packetbufs[fd] = []
-                        if len(recv_data) == 4:
-                            reply = self.event_command(fd, struct.unpack('>I', recv_data)[0])
-                        else:
-                            # All handle_* functions are called in compute_reply
-                            reply = self.compute_reply(recv_data)
-                        if reply is not None:
-                            self.recordbufs[fd].append(reply)
-                            self.p.register(fd, _bothmask)
+        try:
+            records = self.readers[fd].feed(data)
+        except RecordTooLarge, e:
+            print "SERVER: closing %i: %s" % (fd, e)
+            self.event_error(fd)
+            return
+        self.inrecords[fd].extend(records)
+        if self.batch is None:
+            self.process_records(fd, debug)
+        else:
+            self.schedule(fd)
 
-    def event_write(self, fd, chunksize=2048, debug=0):
-        if debug: print "SERVER: In write event for %i" % fd
-        if self.writebufs[fd]:
-            if debug: print "  writing from writebuf"
-            count = self.sockets[fd].send(self.writebufs[fd])
-            self.writebufs[fd] = self.writebufs[fd][count:]
-            # check if done?
-        elif self.recordbufs[fd]:
-            if debug: print "  writing from recordbuf"
-            data = self.recordbufs[fd][0]
-            chunk = data[:chunksize]
-            if len(data) > chunksize:
-                last = 0
-                self.recordbufs[fd][0] = data[chunksize:]
+    def process_records(self, fd, debug=0, limit=None):
+        """Handle the records received on fd, until reading is paused
+
+        At most limit records are handled, if it is given.
+        """
+        records = self.inrecords[fd]
+        while records and not self.read_paused(fd):
+            if limit is not None:
+                if limit <= 0:
+                    return
+                limit -= 1
+            recv_data = records.popleft()
+            if debug: print "SERVER: Received record from %i" % fd
+            if len(recv_data) == 4:
+                reply = self.event_command(fd, struct.unpack('>I', recv_data)[0])
+                self.send_reply(fd, reply)
             else:
-                last = 0x80000000L
-                del self.recordbufs[fd][0]
-            mark = struct.pack('>I', last | len(chunk))
-            self.writebufs[fd] = (mark + chunk)
-            # Duplicated code
-            count = self.sockets[fd].send(self.writebufs[fd])
-            self.writebufs[fd] = self.writebufs[fd][count:]
+                if self.capture is not None:
+                    self.capture.record(fd, recv_data)
+                self.dispatch(fd, recv_data)
+            if fd not in self.sockets:
+                return
+
+    def schedule(self, fd):
+        """Queue fd for a turn at handling its records"""
+        if fd not in self.ready and self.inrecords[fd]:
+            self.ready[fd] = True
+            # Leave the rest in the socket until it has been served
+            self.update_poll(fd)
+
+    def weight(self, fd):
+        """Return how many batches fd handles per turn"""
+        return self.weights.get(self.peers[fd], 1)
+
+    def run_ready(self):
+        """Give each connection waiting in ready its turn, round robin
+
+        Then start the calls this and the last poll queued by class.
+        """
+        for fd in self.ready.keys():
+            del self.ready[fd]
+            if fd not in self.sockets:
+                continue
+            self.process_records(fd, limit=self.batch * self.weight(fd))
+            if fd not in self.sockets:
+                continue
+            if self.inrecords[fd] and not self.read_paused(fd):
+                # Back of the line
+                self.ready[fd] = True
+            else:
+                self.update_poll(fd)
+        if self.classqueues:
+            self.start_calls()
+            if self.pool is None:
+                # Poll again between calls, so urgent ones can overtake
+                for queue in self.classqueues.itervalues():
+                    if queue:
+                        return True
+        return bool(self.ready)
+
+    def dispatch(self, fd, recv_data):
+        """Compute and queue the reply to a call received on fd"""
+        sock = self.sockets[fd]
+        key, found, reply = self.check_drc(self.addrs[fd], recv_data)
+        if found:
+            self.send_reply(fd, reply)
+            return
+        self.inflight[fd] += 1
+        if self.classifier is not None:
+            self.queue_call(fd, sock, recv_data, key)
+        elif self.pool is None:
+            # All handle_* functions are called in compute_reply
+            self.reply_done(fd, sock, self.compute_reply(recv_data), key)
+        elif not self.ordered:
+            self.pool.submit(self._work, fd, sock, recv_data, key)
+        else:
+            queue = self.queuedcalls.setdefault(fd, [])
+            queue.append((recv_data, key))
+            if len(queue) == 1:
+                self.pool.submit(self._work, fd, sock, recv_data, key)
+
+    def queue_call(self, fd, sock, recv_data, key):
+        """Queue a call received on fd under its class"""
+        cls = self.classifier.classify(recv_data)
+        queue = self.classqueues.get(cls)
+        if queue is None:
+            queue = self.classqueues[cls] = deque()
+            self.classinfo[cls] = {"queued" : 0, "maxqueued" : 0,
+                                   "calls" : 0, "wait" : 0.0, "maxwait" : 0.0}
+        queue.append((time.time(), fd, sock, recv_data, key))
+        info = self.classinfo[cls]
+        info["queued"] = len(queue)
+        info["maxqueued"] = max(info["maxqueued"], len(queue))
+        if self.pool is not None:
+            self.start_calls()
+
+    def start_calls(self):
+        """Start queued calls, most urgent class first
+
+        Without a worker pool a single call is run, otherwise as many as
+        there are idle workers.
+        """
+        queues = self.classqueues
+        while self.pool is None or self.running < len(self.pool.threads):
+            for cls in sorted(queues):
+                if queues[cls]:
+                    break
+            else:
+                return
+            queue = queues[cls]
+            stamp, fd, sock, recv_data, key = queue.popleft()
+            wait = time.time() - stamp
+            info = self.classinfo[cls]
+            info["queued"] = len(queue)
+            info["calls"] += 1
+            info["wait"] += wait
+            info["maxwait"] = max(info["maxwait"], wait)
+            if self.sockets.get(fd) is not sock:
+                continue # Connection has gone
+            if self.pool is None:
+                self.reply_done(fd, sock, self.compute_reply(recv_data), key)
+                return
+            self.running += 1
+            self.pool.submit(self._work, fd, sock, recv_data, key)
+
+    def class_stats(self):
+        """Return queue statistics for each priority class
+
+        For each class this gives the calls now queued and the most ever
+        queued, the calls started, and their total and longest wait in
+        seconds.
+        """
+        return dict([(cls, info.copy())
+                     for cls, info in self.classinfo.items()])
+
+    def check_drc(self, addr, recv_data):
+        """Look for a call from addr in the duplicate request cache
+
+        Returns (key, found, reply).  key is None if the call should not be
+        cached.  If found, the call is a retransmission, which should be
+        answered with reply, or dropped if reply is None since the original
+        is still being worked on.
+        """
+        if self.drc is None:
+            return None, False, None
+        key = call_key(recv_data)
+        if key is None:
+            return None, False, None
+        if self.drcprocs is None:
+            if key[3] == 0:
+                return None, False, None
+        elif key[3] not in self.drcprocs:
+            return None, False, None
+        key = (addr,) + key
+        found, reply = self.drc.lookup(key)
+        return key, found, reply
+
+    def event_datagram(self, data, addr, debug=0):
+        if debug: print "SERVER: Received datagram from %s" % (addr,)
+        key, found, reply = self.check_drc(addr, data)
+        if found:
+            # Drop retransmissions of calls still in progress
+            if reply is not None:
+                self.send_datagram(addr, reply)
+        elif self.pool is None:
+            self.datagram_done(addr, self.compute_reply(data), key)
+        else:
+            self.pool.submit(self._work_datagram, addr, data, key)
+
+    def _work_datagram(self, addr, data, key):
+        # Runs in a worker thread
+        try:
+            reply = self.compute_reply(data)
+        except Exception:
+            traceback.print_exc()
+            reply = self.error_reply(data)
+        self.call_soon(self.datagram_done, addr, reply, key)
+
+    def datagram_done(self, addr, reply, key=None):
+        if isinstance(reply, Deferred):
+            reply.add_callback(lambda r: self.datagram_done(addr, r, key))
+            return
+        if key is not None:
+            self.drc.store(key, reply)
+        if reply is not None:
+            self.send_datagram(addr, reply)
+
+    def _work(self, fd, sock, recv_data, key):
+        # Runs in a worker thread.  reply_done must always follow, to
+        # start the next ordered or classified call.
+        try:
+            reply = self.compute_reply(recv_data)
+        except Exception:
+            traceback.print_exc()
+            reply = self.error_reply(recv_data)
+        self.call_soon(self.reply_done, fd, sock, reply, key, True)
+
+    def error_reply(self, recv_data):
+        """Return a SYSTEM_ERR reply to a call, or None if there can't be one"""
+        try:
+            out = unpack_call_header(recv_data)
+            if out is None:
+                self.rpcunpacker.reset(recv_data)
+                out = self.rpcunpacker.unpack_rpc_msg(), None
+            msg = out[0]
+            cred = msg.body.cbody.cred
+            return self.pack_reply(msg.xid, cred.flavor, cred, SYSTEM_ERR, '')
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def reply_done(self, fd, sock, reply, key=None, pooled=False):
+        """Send the result of compute_reply, and start the next ordered call"""
+        if isinstance(reply, Deferred):
+            reply.add_callback(lambda r: self.finish_reply(fd, sock, r, key))
+        else:
+            self.finish_reply(fd, sock, reply, key)
+        if pooled and self.classifier is not None:
+            self.running -= 1
+            self.start_calls()
+        if pooled and self.ordered and self.sockets.get(fd) is sock:
+            queue = self.queuedcalls[fd]
+            del queue[0]
+            if queue:
+                self.pool.submit(self._work, fd, sock, *queue[0])
+
+    def finish_reply(self, fd, sock, reply, key=None):
+        """Cache reply if needed, then send it"""
+        if key is not None:
+            self.drc.store(key, reply)
+        if self.sockets.get(fd) is not sock:
+            return
+        full = self.inflight_full(fd)
+        self.inflight[fd] -= 1
+        self.send_reply(fd, reply, sock)
+        if full and not self.read_paused(fd):
+            self.resume_reading(fd)
+
+    def send_reply(self, fd, reply, sock=None):
+        """Queue a reply record for transmission on fd
+
+        If sock is given, the reply is dropped unless fd still refers to it
+        (the connection may have closed while the reply was deferred).
+        """
+        if reply is None:
+            return
+        if sock is not None and self.sockets.get(fd) is not sock:
+            return
+        self.recordbufs[fd].append(reply)
+        if isinstance(reply, str):
+            size = len(reply)
+        else:
+            size = sum([len(piece) for piece in reply])
+        # Count the record marks too
+        if self.fragsize and size > self.fragsize:
+            size += 4 * ((size + self.fragsize - 1) // self.fragsize)
         else:
-            if debug: print "  done writing"
-            self.p.register(fd, _readmask)
+            size += 4
+        self.outbytes[fd] += size
+        self.outtotal += size
+        if self.maxoutput is not None and fd not in self.stalled and \
+               self.outbytes[fd] > self.maxoutput:
+            self.stalled.add(fd)
+            self.stalls += 1
+        if self.maxoutputtotal is not None and not self.globalstall and \
+               self.outtotal > self.maxoutputtotal:
+            self.globalstall = True
+            self.globalstalls += 1
+            for other in self.sockets:
+                if other != fd:
+                    self.update_poll(other)
+        self.update_poll(fd)
+
+    def sent_output(self, fd, count):
+        """Account for count bytes of output having gone from fd"""
+        self.outbytes[fd] -= count
+        self.outtotal -= count
+        if fd in self.stalled and self.outbytes[fd] <= self.maxoutput // 2:
+            self.stalled.discard(fd)
+            self.resume_reading(fd)
+        self.check_globalstall()
+
+    def check_globalstall(self):
+        """Resume reading everywhere once total output has dropped"""
+        if self.globalstall and \
+               self.outtotal <= self.maxoutputtotal // 2:
+            self.globalstall = False
+            for fd in self.sockets.keys():
+                if fd in self.sockets and fd not in self.stalled:
+                    self.resume_reading(fd)
+
+    def resume_reading(self, fd):
+        self.update_poll(fd)
+        if self.batch is None:
+            self.process_records(fd)
+        else:
+            self.schedule(fd)
+
+    def output_stats(self):
+        """Return counts of output queued and of reading being stalled"""
+        return {"queued" : self.outtotal,
+                "stalled" : len(self.stalled),
+                "stalls" : self.stalls,
+                "globalstall" : self.globalstall,
+                "globalstalls" : self.globalstalls}
+
+    def write_pending(self, fd):
+        return bool(self.writebufs[fd] or self.recordbufs[fd])
+
+    def inflight_full(self, fd):
+        """Return True if fd has as many calls in progress as allowed"""
+        return self.maxinflight is not None and \
+               self.inflight[fd] >= self.maxinflight
+
+    def read_paused(self, fd):
+        return self.globalstall or fd in self.stalled or \
+               fd in self.ready or self.inflight_full(fd)
+
+    def busy(self, fd):
+        return bool(self.inflight[fd] or self.inrecords[fd] or
+                    self.write_pending(fd))
+
+    def event_write(self, fd, debug=0):
+        if debug: print "SERVER: In write event for %i" % fd
+        bufs = self.writebufs[fd]
+        if not bufs:
+            if not self.recordbufs[fd]:
+                if debug: print "  done writing"
+                self.update_poll(fd)
+                return
+            if debug: print "  starting next records"
+            # Take every queued reply, so a burst goes out in few sends
+            records = self.recordbufs[fd]
+            while records:
+                bufs.extend(frame_record(records.popleft(), self.fragsize))
+        count = send_buffers(self.sockets[fd], bufs)
+        consume_buffers(bufs, count)
+        self.sent_output(fd, count)
 
     def event_command(self, cfd, comm, debug=0):
         if debug:
@@ -638,25 +3031,45 @@ class RPCServer(Server):
             print "SERVER: closing %i" % fd
         self.event_error(fd)
 
-    def event_error(self, fd):
+    def event_error(self, fd, debug=0):
         self.p.unregister(fd)
         self.sockets[fd].close()
-        del self.readbufs[fd]
+        del self.readers[fd]
+        del self.inrecords[fd]
+        del self.inflight[fd]
         del self.writebufs[fd]
-        del self.packetbufs[fd]
         del self.recordbufs[fd]
         del self.sockets[fd]
+        del self.peers[fd]
+        del self.addrs[fd]
+        self.queuedcalls.pop(fd, None)
+        self.ready.pop(fd, None)
+        self.stalled.discard(fd)
+        self.outtotal -= self.outbytes.pop(fd)
+        self.check_globalstall()
+        self.connection_closed(fd)
         
     event_hup = event_error
 
     def compute_reply(self, recv_data):
+        """Return the reply to a call record
+
+        The reply is a list of strings to be sent as one record, a Deferred
+        for such a list, or None if no reply should be sent.
+        """
+        if self.metrics is not None:
+            start = time.time()
         # Decode RPC specific info
-        self.rpcunpacker.reset(recv_data)
-        try:
-            recv_msg = self.rpcunpacker.unpack_rpc_msg()
-        except xdrlib.Error, e:
-            print "XDRError", e
-            return
+        out = unpack_call_header(recv_data)
+        if out is None:
+            self.rpcunpacker.reset(recv_data)
+            try:
+                out = (self.rpcunpacker.unpack_rpc_msg(),
+                       self.rpcunpacker.get_position())
+            except xdrlib.Error, e:
+                print "XDRError", e
+                return
+        recv_msg, pos = out
         if recv_msg.body.mtype != CALL:
             print "Received a REPLY, expected a CALL"
             return
@@ -678,7 +3091,7 @@ class RPCServer(Server):
             reply_stat = MSG_DENIED
         # At this point recv_msg has been accepted
         # Check for reasons to fail before calling handle_*
-        meth_data = recv_data[self.rpcunpacker.get_position():]
+        meth_data = recv_data[pos:]
         meth_data = self.security[flavor].unsecure_data(meth_data, cred)
         if rreply:
             pass
@@ -697,16 +3110,89 @@ class RPCServer(Server):
         # Call appropriate handle_*
         else:
             method = getattr(self, "handle_%i" % call.proc)
-            a_stat, proc_response = method(meth_data, cred)
-            verf = self.security[flavor].make_reply_verf(cred, a_stat)
-            if a_stat == SUCCESS:
-                proc_response = self.security[flavor].secure_data(proc_response, cred)
-            areply = accepted_reply(verf, rpc_reply_data(a_stat, ''))
+            result = method(meth_data, cred)
+            if type(result) is types.GeneratorType:
+                result = self.run_coroutine(result)
+            if isinstance(result, Deferred):
+                # Finish the reply back on the poll loop thread
+                out = Deferred()
+                def finish(res, xid=recv_msg.xid):
+                    if isinstance(res, Exception):
+                        traceback.print_exception(type(res), res, None)
+                        res = SYSTEM_ERR, ''
+                    reply = self.pack_reply(xid, flavor, cred, *res)
+                    if self.metrics is not None:
+                        self.count_call(call, start, recv_data, reply,
+                                        res[0] != SUCCESS)
+                    out.callback(reply)
+                result.add_callback(lambda res: self.call_soon(finish, res))
+                return out
+            a_stat, proc_response = result
+            reply = self.pack_reply(recv_msg.xid, flavor, cred,
+                                    a_stat, proc_response)
+            if self.metrics is not None:
+                self.count_call(call, start, recv_data, reply,
+                                a_stat != SUCCESS)
+            return reply
         # Build reply
         body = reply_body(reply_stat, areply, rreply)
         msg = rpc_msg(recv_msg.xid, rpc_msg_body(REPLY, rbody=body))
         self.rpcpacker.reset()
         self.rpcpacker.pack_rpc_msg(msg)
-        return self.rpcpacker.get_buffer() + proc_response
+        reply = [self.rpcpacker.get_buffer(), proc_response]
+        if self.metrics is not None:
+            self.count_call(call, start, recv_data, reply, True)
+        return reply
 
     __compute_reply_orig = compute_reply
+
+    def pack_reply(self, xid, flavor, cred, a_stat, proc_response):
+        """Build the accepted reply record for a handled call
+
+        The record is returned as a list of strings, the rpc header and the
+        procedure response, which are sent without being joined.
+        """
+        verf = self.security[flavor].make_reply_verf(cred, a_stat)
+        if a_stat == SUCCESS:
+            proc_response = self.security[flavor].secure_data(proc_response, cred)
+        areply = accepted_reply(verf, rpc_reply_data(a_stat, ''))
+        body = reply_body(MSG_ACCEPTED, areply, None)
+        msg = rpc_msg(xid, rpc_msg_body(REPLY, rbody=body))
+        self.rpcpacker.reset()
+        self.rpcpacker.pack_rpc_msg(msg)
+        return [self.rpcpacker.get_buffer(), proc_response]
+
+    def run_coroutine(self, gen):
+        """Drive a generator handle_* method, returning a Deferred
+
+        The generator may yield Deferreds; it is resumed on the poll loop
+        thread with each one's result, or has it raised if the result is an
+        exception.  The first value it yields that is not a Deferred is
+        taken as its (a_stat, data) result.  If it raises, or finishes
+        without a result, the call fails with SYSTEM_ERR.
+        """
+        out = Deferred()
+        def step(value):
+            while 1:
+                try:
+                    if isinstance(value, Exception):
+                        res = gen.throw(value)
+                    else:
+                        res = gen.send(value)
+                except StopIteration:
+                    out.callback((SYSTEM_ERR, ''))
+                    return
+                except Exception:
+                    traceback.print_exc()
+                    out.callback((SYSTEM_ERR, ''))
+                    return
+                if not isinstance(res, Deferred):
+                    gen.close()
+                    out.callback(res)
+                    return
+                if not res.called:
+                    res.add_callback(lambda r: self.call_soon(step, r))
+                    return
+                value = res.result
+        step(None)
+        return out
@@ -6,6 +6,10 @@ class SecError(Exception):
 
 class SecFlavor(object):
     _none = opaque_auth(AUTH_NONE, '')
+
+    # True if make_cred and make_verf give the same for every call, so
+    # packed call headers may be reused
+    fixed_header = True
     
     def initialize(self, client):
         pass
@@ -91,6 +91,7 @@ def hint_string(d):
 
 class SecAuthGss(SecFlavor):
     krb5_oid = "\x2a\x86\x48\x86\xf7\x12\x01\x02\x02"
+    fixed_header = False # each call has its own sequence number and MIC
     def __init__(self, service=rpc_gss_svc_none):
         t = threading.currentThread()
         self.lock = threading.Lock()
@@ -125,7 +126,7 @@ class SecAuthGss(SecFlavor):
     def initialize(self, client): # Note this is not thread safe
         """Set seq_num, init, handle, and context"""
         self.gss_seq_num = 0
-        d = gssapi.importName("nfs@%s" % client.remotehost)
+        d = gssapi.importName("nfs@%s" % client.servername)
         if d['major'] != gssapi.GSS_S_COMPLETE:
             raise SecError, "gssapi.importName returned: %s" % \
                   show_major(d['major'])
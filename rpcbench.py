@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# rpcbench.py - microbenchmarks for the rpc library
+#
+# Requires python 2.7
+#
+# Each benchmark runs a server and client in this process, and prints
+# calls or records per second for the variants being compared.
+#
+
+# Allow to be run stright from package root
+if  __name__ == "__main__":
+    import os.path
+    import sys
+    if os.path.isfile(os.path.join(sys.path[0], 'lib', 'testmod.py')):
+        sys.path.insert(1, os.path.join(sys.path[0], 'lib'))
+
+import os
+import sys
+import time
+import tempfile
+import struct
+import socket
+import threading
+from optparse import OptionParser
+import rpc.rpc as rpc
+import rpc.rpc_pack as rpc_pack
+
+PROG = 0x40000000 + 54321
+MiB = 1024 * 1024
+
+class EchoServer(rpc.RPCServer):
+    """Procedure 1 echoes its arguments, procedure 2 returns size bytes,
+    and procedure 3 discards its arguments, like a WRITE
+    """
+    def __init__(self, size=MiB, **kwargs):
+        kwargs.setdefault("port", 0)
+        rpc.RPCServer.__init__(self, prog=PROG, vers=1, **kwargs)
+        self.data = 'x' * size
+
+    def handle_1(self, data, cred):
+        return rpc.SUCCESS, data
+
+    def handle_2(self, data, cred):
+        return rpc.SUCCESS, self.data
+
+    def handle_3(self, data, cred):
+        return rpc.SUCCESS, ''
+
+def start_server(**kwargs):
+    server = EchoServer(**kwargs)
+    t = threading.Thread(target=server.run, name="bench server")
+    t.setDaemon(True)
+    t.start()
+    return server
+
+def report(name, count, elapsed, nbytes=0):
+    line = "  %-28s %8.1f/s" % (name, count / elapsed)
+    if nbytes:
+        line += "  %8.1f MiB/s" % (nbytes / elapsed / MiB)
+    print line
+
+def timeit(func, count):
+    start = time.time()
+    for i in xrange(count):
+        func()
+    return time.time() - start
+
+###################################################
+
+def _recv_record_concat(sock):
+    """The original string-concatenating record receive, for comparison"""
+    def recv_all(n):
+        data = ""
+        while n > 0:
+            newdata = sock.recv(n)
+            if not newdata:
+                raise socket.error("Connection closed")
+            data += newdata
+            n -= len(newdata)
+        return data
+    last = False
+    data = ""
+    while not last:
+        count = struct.unpack('>I', recv_all(4))[0]
+        last = count & 0x80000000L
+        if last:
+            count &= 0x7fffffffL
+        data += recv_all(count)
+    return data
+
+def fragments(data, chunksize=2048):
+    """Return data record marked in chunksize fragments"""
+    out = []
+    for i in xrange(0, len(data), chunksize):
+        chunk = data[i:i + chunksize]
+        last = (i + chunksize >= len(data)) and 0x80000000L or 0
+        out.append(struct.pack('>I', last | len(chunk)) + chunk)
+    return ''.join(out)
+
+def writer_process(sock, data, count):
+    """Fork a process that sends data count times down sock"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            for i in xrange(count):
+                sock.sendall(data)
+        finally:
+            os._exit(0)
+    return pid
+
+def bench_recv(opts):
+    """Receive records of --size bytes sent in --fragment sized pieces"""
+    a, b = [socket.socket(_sock=s) for s in socket.socketpair()]
+    record = fragments('x' * opts.size, opts.fragment)
+    variants = [("concatenate", lambda: _recv_record_concat(b)),
+                ("recv_record", b.recv_record),
+                ("recv_record_view", b.recv_record_view)]
+    for name, func in variants:
+        pid = writer_process(a, record, opts.count)
+        elapsed = timeit(func, opts.count)
+        os.waitpid(pid, 0)
+        report(name, opts.count, elapsed, opts.count * opts.size)
+    server = start_server(size=opts.size)
+    client = rpc.RPCClient('localhost', server.port, program=PROG, version=1)
+    elapsed = timeit(lambda: client.call(2), opts.count)
+    report("RPCClient.call", opts.count, elapsed, opts.count * opts.size)
+
+def _send_record_chunked(sock, data, chunksize=2048):
+    """The original chunk by chunk record send, for comparison"""
+    dlen = len(data)
+    i = last = 0
+    while not last:
+        chunk = data[i:i+chunksize]
+        i += chunksize
+        if i >= dlen:
+            last = 0x80000000L
+        mark = struct.pack('>I', last | len(chunk))
+        sock.sendall(mark + chunk)
+
+def reader_process(sock, count):
+    """Fork a process that reads count records from sock"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            for i in xrange(count):
+                sock.recv_record_view()
+        finally:
+            os._exit(0)
+    return pid
+
+def bench_send(opts):
+    """Send WRITE sized records of --size bytes"""
+    a, b = [socket.socket(_sock=s) for s in socket.socketpair()]
+    header = 'h' * 40
+    data = 'x' * opts.size
+    variants = [("chunked concatenate",
+                 lambda: _send_record_chunked(a, header + data)),
+                ("send_record %i" % opts.fragment,
+                 lambda: a.send_record([header, data], opts.fragment)),
+                ("send_record",
+                 lambda: a.send_record([header, data]))]
+    for name, func in variants:
+        pid = reader_process(b, opts.count)
+        elapsed = timeit(func, opts.count)
+        os.waitpid(pid, 0)
+        report(name, opts.count, elapsed, opts.count * opts.size)
+    server = start_server()
+    for fragsize in (opts.fragment, None):
+        client = rpc.RPCClient('localhost', server.port, program=PROG,
+                               version=1, fragsize=fragsize)
+        elapsed = timeit(lambda: client.call(3, data), opts.count)
+        report("RPCClient.call fragsize=%s" % fragsize,
+               opts.count, elapsed, opts.count * opts.size)
+
+def bench_null(opts):
+    """NULL call latency over TCP, Unix sockets and in-process loopback"""
+    def run(name, client):
+        elapsed = timeit(lambda: client.call(0), opts.count)
+        report(name, opts.count, elapsed)
+        print "    %.1f usec per call" % (elapsed / opts.count * 1e6)
+    path = os.path.join(tempfile.mkdtemp(), "rpcbench.sock")
+    try:
+        for name, host, kwargs in (("tcp", "localhost", {}),
+                                   ("tcp nodelay", "localhost",
+                                    {"nodelay" : True}),
+                                   ("unix", "unix:" + path, {})):
+            server = start_server(host=host, **kwargs)
+            run(name, rpc.RPCClient(host, server.port,
+                                    program=PROG, version=1))
+        server = EchoServer()
+        run("loopback", rpc.RPCClient(server, None, program=PROG, version=1))
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+def bench_batch(opts):
+    """NULL calls made one at a time and in batches with call_many"""
+    batch = 100
+    count = max(opts.count // batch, 1) * batch
+    for kwargs in ({}, {"workers" : 4, "nodelay" : True}):
+        server = start_server(**kwargs)
+        client = rpc.RPCClient('localhost', server.port,
+                               program=PROG, version=1)
+        print "    server options %s" % kwargs
+        elapsed = timeit(lambda: client.call(0), count)
+        report("call", count, elapsed)
+        calls = [(0, '')] * batch
+        elapsed = timeit(lambda: client.call_many(calls), count // batch)
+        report("call_many %i" % batch, count, elapsed)
+
+def bench_header(opts):
+    """Decode call and reply headers with struct and with the generic unpacker"""
+    from rpc.rpcsec.sec_auth_sys import SecAuthSys
+    count = opts.count * 100
+    server = EchoServer()
+    unpacker = rpc_pack.RPCUnpacker('')
+    def generic(data):
+        unpacker.reset(data)
+        unpacker.unpack_rpc_msg()
+    for name, sec, flavor in (("AUTH_NONE", rpc.SecAuthNone(), rpc.AUTH_NONE),
+                              ("AUTH_SYS", SecAuthSys(0, 'bench', 0, 0, []),
+                               rpc.AUTH_SYS)):
+        client = rpc.RPCClient(server, None, program=PROG, version=1,
+                               sec_list=[sec])
+        call = client.get_call_header(1, PROG, 1, 1)[0]
+        reply = ''.join(server.pack_reply(1, flavor, None, rpc.SUCCESS, ''))
+        print "    %s" % name
+        for name, data, fast in (("call", call, rpc.unpack_call_header),
+                                 ("reply", reply, rpc.unpack_reply_header)):
+            report("%s unpack_rpc_msg" % name, count,
+                   timeit(lambda: generic(data), count))
+            report("%s struct" % name, count,
+                   timeit(lambda: fast(data), count))
+
+def percentile(values, p):
+    """Return the p'th percentile of a sorted list"""
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+def bench_fair(opts):
+    """NULL call latency beside a client pipelining WRITEs, with batch"""
+    for kwargs in ({}, {"batch" : 8}):
+        server = start_server(**kwargs)
+        heavy = rpc.RPCClient('localhost', server.port,
+                              program=PROG, version=1)
+        light = rpc.RPCClient('localhost', server.port,
+                              program=PROG, version=1)
+        done = []
+        def pipeline():
+            calls = [(3, 'x' * opts.fragment)] * 500
+            while not done:
+                heavy.call_many(calls)
+        t = threading.Thread(target=pipeline, name="bench heavy")
+        t.start()
+        latencies = []
+        try:
+            time.sleep(0.1)
+            for i in xrange(opts.count):
+                start = time.time()
+                light.call(0)
+                latencies.append(time.time() - start)
+        finally:
+            done.append(True)
+            t.join()
+        latencies.sort()
+        print "    server options %s, latency in msecs:" % kwargs
+        print "      p50 %.3f  p99 %.3f  max %.3f" % \
+              tuple([1000 * x for x in (percentile(latencies, 50),
+                                        percentile(latencies, 99),
+                                        latencies[-1])])
+
+benchmarks = {
+    "batch" : bench_batch,
+    "fair" : bench_fair,
+    "header" : bench_header,
+    "null" : bench_null,
+    "recv" : bench_recv,
+    "send" : bench_send,
+    }
+
+def main():
+    p = OptionParser("%prog [options] benchmark ...",
+                     description="Available benchmarks: %s" %
+                     ", ".join(sorted(benchmarks)))
+    p.add_option("-n", "--count", type="int", default=200,
+                 help="Number of iterations [%default]")
+    p.add_option("-s", "--size", type="int", default=MiB,
+                 help="Payload size in bytes [%default]")
+    p.add_option("-f", "--fragment", type="int", default=2048,
+                 help="Record fragment size in bytes [%default]")
+    opts, args = p.parse_args()
+    if not args:
+        args = sorted(benchmarks)
+    for name in args:
+        if name not in benchmarks:
+            p.error("Unknown benchmark %s" % name)
+    for name in args:
+        print "%s: %s" % (name, benchmarks[name].__doc__)
+        benchmarks[name](opts)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# rpcproxy.py - forward RPC over TCP, adding latency and faults
+#
+# Requires python 2.7
+#
+# Sits between clients and a server, passing whole records each way, and
+# delays, drops, duplicates, reorders or resets them as configured for
+# each procedure.  This gives a way to exercise client retransmission,
+# the server's duplicate request cache and lease expiry under WAN-like
+# conditions without leaving the machine.
+#
+
+# Allow to be run stright from package root
+if  __name__ == "__main__":
+    import os.path
+    import sys
+    if os.path.isfile(os.path.join(sys.path[0], 'lib', 'testmod.py')):
+        sys.path.insert(1, os.path.join(sys.path[0], 'lib'))
+
+import os
+import sys
+import time
+import errno
+import heapq
+import random
+import struct
+import socket
+from collections import deque
+from optparse import OptionParser
+import rpc.rpc as rpc
+
+class Fault(object):
+    """What to do to the records of a procedure
+
+    delay and jitter are in seconds, each record being held back for delay
+    plus a random part of jitter.  drop, duplicate, reorder and reset are
+    the chances that a record is lost, sent twice, sent after the next
+    record going the same way, or has its connection reset instead of
+    being sent.  side says whether this applies to the procedure's
+    'call's, 'reply's or 'both'.
+    """
+    def __init__(self, delay=0.0, jitter=0.0, drop=0.0, duplicate=0.0,
+                 reorder=0.0, reset=0.0, side='call'):
+        if side not in ('call', 'reply', 'both'):
+            raise ValueError("Unknown side %r" % side)
+        self.delay = delay
+        self.jitter = jitter
+        self.drop = drop
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reset = reset
+        self.side = side
+
+    def applies(self, reply):
+        if reply:
+            return self.side != 'call'
+        return self.side != 'reply'
+
+_call_struct = struct.Struct('>6I') # xid, mtype, rpcvers, prog, vers, proc
+
+class Proxy(rpc.Server):
+    """Forward connections on host and port to target, injecting faults
+
+    target is a (host, port) pair, or a 'unix:/path' string.  faults maps
+    (prog, proc) or proc to the Fault for that procedure; the rest get
+    default.  A record held back to be reordered goes anyway after
+    holdtime seconds if no other record follows it.  seed makes the
+    faults repeatable.
+
+    Connections to target are made without blocking the poll loop, and
+    given up (closing the client's connection) after connecttimeout
+    seconds.
+    """
+    def __init__(self, target, faults=None, default=None, host='', port=0,
+                 holdtime=0.1, seed=None, connecttimeout=10.0, **kwargs):
+        rpc.Server.__init__(self, host, port, name="PROXY", **kwargs)
+        self.target = target
+        path = rpc.unix_path(target)
+        if path is not None:
+            self.targetaddr = socket.AF_UNIX, path
+        else:
+            # Look the name up once, rather than on the poll loop each time
+            family, type, proto, name, addr = \
+                    socket.getaddrinfo(target[0], target[1], 0,
+                                       socket.SOCK_STREAM)[0]
+            self.targetaddr = family, addr
+        self.connecttimeout = connecttimeout
+        self.faults = faults or {}
+        self.default = default or Fault()
+        self.holdtime = holdtime
+        self.random = random.Random(seed)
+        self.sockets = {}  # fd -> socket, for both sides
+        self.peer = {}     # fd -> fd of the other side
+        self.upstream = set() # fds connected to the target
+        self.connecting = set() # upstream fds whose connect is under way
+        self.readers = {}  # fd -> RecordReader
+        self.outbufs = {}  # fd -> deque of buffers to send
+        self.calls = {}    # upstream fd -> {xid : (prog, proc)}
+        self.held = {}     # fd -> record held back for reordering
+        self.timers = []   # heap of (time, seq, func, args)
+        self.seq = 0
+        self.counts = dict.fromkeys(["connections", "forwarded", "dropped",
+                                     "duplicated", "reordered", "delayed",
+                                     "resets"], 0)
+        self.s.listen(self.backlog)
+
+    def connect_target(self):
+        """Return a socket connecting to target, and whether it has yet"""
+        family, addr = self.targetaddr
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setblocking(0)
+        err = s.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS):
+            s.close()
+            raise socket.error(err, os.strerror(err))
+        self.setup_socket(s)
+        return s, err == 0
+
+    def add_socket(self, sock):
+        fd = sock.fileno()
+        self.sockets[fd] = sock
+        self.readers[fd] = rpc.RecordReader()
+        self.outbufs[fd] = deque()
+        self.update_poll(fd)
+        return fd
+
+    def event_connect(self, fd, debug=0):
+        csock, caddr = self.s.accept()
+        try:
+            usock, connected = self.connect_target()
+        except socket.error, e:
+            print "%s: can not reach %s: %s" % (self.name, self.target, e)
+            csock.close()
+            return
+        csock.setblocking(0)
+        self.setup_socket(csock)
+        cfd = self.add_socket(csock)
+        ufd = self.add_socket(usock)
+        self.peer[cfd] = ufd
+        self.peer[ufd] = cfd
+        self.upstream.add(ufd)
+        self.calls[ufd] = {}
+        if not connected:
+            # Finished in event_write, once the socket is writable
+            self.connecting.add(ufd)
+            self.update_poll(ufd)
+            self.call_later(self.connecttimeout, self.connect_timedout,
+                            ufd, usock)
+        self.counts["connections"] += 1
+        if debug:
+            print "%s: %s connected as %i, upstream %i" % \
+                  (self.name, caddr, cfd, ufd)
+        self.connection_opened(cfd)
+
+    def event_read(self, fd, data, debug=0):
+        try:
+            records = self.readers[fd].feed(data)
+        except rpc.RecordTooLarge, e:
+            self.event_error(fd)
+            return
+        for record in records:
+            self.forward(fd, record)
+            if fd not in self.sockets:
+                return
+
+    def find_fault(self, fd, record):
+        """Return the Fault for a record received on fd, or None"""
+        try:
+            xid, mtype, rpcvers, prog, vers, proc = \
+                 _call_struct.unpack_from(record)
+        except struct.error:
+            xid = mtype = None
+        reply = fd in self.upstream
+        if reply:
+            key = self.calls[fd].pop(xid, None)
+        elif mtype == rpc.CALL:
+            key = (prog, proc)
+            self.calls[self.peer[fd]][xid] = key
+        else:
+            key = None
+        fault = self.faults.get(key)
+        if fault is None and key is not None:
+            fault = self.faults.get(key[1])
+        if fault is None:
+            fault = self.default
+        if fault.applies(reply):
+            return fault
+        return None
+
+    def forward(self, fd, record):
+        """Pass a record received on fd to the other side"""
+        fault = self.find_fault(fd, record)
+        out = self.peer[fd]
+        sock = self.sockets[out]
+        if fault is None:
+            self.send(out, sock, record)
+            return
+        r = self.random.random
+        if r() < fault.reset:
+            self.counts["resets"] += 1
+            self.reset(fd)
+            return
+        if r() < fault.drop:
+            self.counts["dropped"] += 1
+            return
+        copies = 1
+        if r() < fault.duplicate:
+            self.counts["duplicated"] += 1
+            copies = 2
+        hold = r() < fault.reorder
+        delay = fault.delay + fault.jitter * r()
+        if delay:
+            self.counts["delayed"] += 1
+            self.call_later(delay, self.deliver, out, sock, record, copies,
+                            hold)
+        else:
+            self.deliver(out, sock, record, copies, hold)
+
+    def deliver(self, fd, sock, record, copies=1, hold=False):
+        if hold and fd not in self.held:
+            self.counts["reordered"] += 1
+            self.held[fd] = record
+            self.call_later(self.holdtime, self.release, fd, sock, record)
+            copies -= 1
+        for i in range(copies):
+            self.send(fd, sock, record)
+
+    def release(self, fd, sock, record):
+        """Send a record held back on fd, if it is still waiting"""
+        if self.held.get(fd) is record:
+            del self.held[fd]
+            self.send(fd, sock, record)
+
+    def send(self, fd, sock, record):
+        """Queue a record to go out on fd, unless sock has since closed"""
+        if self.sockets.get(fd) is not sock:
+            return
+        self.counts["forwarded"] += 1
+        self.outbufs[fd].extend(rpc.frame_record(record))
+        held = self.held.pop(fd, None)
+        if held is not None:
+            # Goes out after the record that overtook it
+            self.counts["forwarded"] += 1
+            self.outbufs[fd].extend(rpc.frame_record(held))
+        self.update_poll(fd)
+
+    def write_pending(self, fd):
+        return fd in self.connecting or bool(self.outbufs[fd])
+
+    def read_paused(self, fd):
+        return fd in self.connecting
+
+    def connect_timedout(self, fd, sock):
+        if fd in self.connecting and self.sockets.get(fd) is sock:
+            print "%s: can not reach %s: timed out" % (self.name, self.target)
+            self.event_error(fd)
+
+    def event_write(self, fd, debug=0):
+        if fd not in self.sockets:
+            # Closed along with its peer
+            return
+        if fd in self.connecting:
+            err = self.sockets[fd].getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_ERROR)
+            if err:
+                print "%s: can not reach %s: %s" % \
+                      (self.name, self.target, os.strerror(err))
+                self.event_error(fd)
+                return
+            self.connecting.discard(fd)
+        bufs = self.outbufs[fd]
+        if bufs:
+            rpc.consume_buffers(bufs, rpc.send_buffers(self.sockets[fd], bufs))
+        if not bufs:
+            self.update_poll(fd)
+
+    def reset(self, fd):
+        """Abort both sides of the connection fd belongs to"""
+        for side in (fd, self.peer[fd]):
+            # Linger with a zero timeout makes close send a RST
+            self.sockets[side].setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                          struct.pack('ii', 1, 0))
+        self.event_close(fd)
+
+    def event_close(self, fd, debug=0):
+        if debug:
+            print "%s: closing %i" % (self.name, fd)
+        self.event_error(fd)
+
+    def event_error(self, fd, debug=0):
+        if fd not in self.sockets:
+            return
+        for side in (fd, self.peer[fd]):
+            self.p.unregister(side)
+            self.sockets.pop(side).close()
+            del self.readers[side]
+            del self.outbufs[side]
+            del self.peer[side]
+            self.held.pop(side, None)
+            self.calls.pop(side, None)
+            self.upstream.discard(side)
+            self.connecting.discard(side)
+            self.connection_closed(side)
+
+    event_hup = event_error
+
+    def call_later(self, delay, func, *args):
+        """Run func(*args) from the poll loop in delay seconds"""
+        self.seq += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.seq,
+                                     func, args))
+
+    def run_ready(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, func, args = heapq.heappop(self.timers)
+            func(*args)
+        return False
+
+    def close_idle(self):
+        timeout = rpc.Server.close_idle(self)
+        if self.timers:
+            wait = int((self.timers[0][0] - time.time()) * 1000) + 1
+            if timeout is None or wait < timeout:
+                timeout = max(wait, 0)
+        return timeout
+
+def parse_fault(spec, fault=None):
+    """Parse 'name=value,...' into a Fault, starting from fault's settings
+
+    Times are given in milliseconds.
+    """
+    kwargs = {}
+    if fault is not None:
+        kwargs = dict(fault.__dict__)
+    for item in spec.split(','):
+        if not item:
+            continue
+        name, sep, value = item.partition('=')
+        if name in ('delay', 'jitter'):
+            kwargs[name] = float(value) / 1000
+        elif name in ('drop', 'duplicate', 'reorder', 'reset'):
+            kwargs[name] = float(value)
+        elif name == 'side':
+            kwargs[name] = value
+        else:
+            raise ValueError("Unknown fault %r" % name)
+    return Fault(**kwargs)
+
+def main():
+    p = OptionParser("%prog [options] host [port]",
+                     description="Forward RPC connections to the server at "
+                     "host and port, delaying, dropping, duplicating, "
+                     "reordering or resetting records.  host may be "
+                     "unix:/path for a Unix socket.  The options set the "
+                     "faults for every procedure, -p for one.")
+    p.add_option("-l", "--listen", default="",
+                 help="Address to listen on, or unix:/path")
+    p.add_option("-P", "--listen-port", type="int", default=0,
+                 help="Port to listen on, 0 for any [%default]")
+    p.add_option("-d", "--delay", type="float", default=0.0,
+                 help="Delay in msecs [%default]")
+    p.add_option("-j", "--jitter", type="float", default=0.0,
+                 help="Add up to this many msecs of random delay [%default]")
+    p.add_option("--drop", type="float", default=0.0,
+                 help="Chance of dropping a record [%default]")
+    p.add_option("--duplicate", type="float", default=0.0,
+                 help="Chance of sending a record twice [%default]")
+    p.add_option("--reorder", type="float", default=0.0,
+                 help="Chance of sending a record after the next one "
+                 "[%default]")
+    p.add_option("--reset", type="float", default=0.0,
+                 help="Chance of resetting the connection instead "
+                 "[%default]")
+    p.add_option("--side", default="call", choices=["call", "reply", "both"],
+                 help="Apply faults to calls, replies or both [%default]")
+    p.add_option("-p", "--proc", action="append", default=[],
+                 metavar="[PROG/]PROC:NAME=VALUE,...",
+                 help="Faults for one procedure, e.g. 1:drop=0.1,side=reply; "
+                 "unset ones are taken from the options above")
+    p.add_option("-s", "--seed", type="int", default=None,
+                 help="Seed for repeatable faults")
+    p.add_option("-t", "--connect-timeout", type="float", default=10.0,
+                 help="Seconds to wait for the server to accept a "
+                 "connection [%default]")
+    opts, args = p.parse_args()
+    if len(args) not in (1, 2):
+        p.error("Need a server")
+    target = args[0]
+    if rpc.unix_path(target) is None:
+        port = 2049
+        if len(args) == 2:
+            port = int(args[1])
+        target = (target, port)
+    try:
+        default = Fault(opts.delay / 1000, opts.jitter / 1000, opts.drop,
+                        opts.duplicate, opts.reorder, opts.reset, opts.side)
+        faults = {}
+        for spec in opts.proc:
+            key, sep, spec = spec.partition(':')
+            if '/' in key:
+                prog, proc = key.split('/')
+                key = (int(prog), int(proc))
+            else:
+                key = int(key)
+            faults[key] = parse_fault(spec, default)
+    except ValueError, e:
+        p.error(e)
+    proxy = Proxy(target, faults, default, opts.listen, opts.listen_port,
+                  seed=opts.seed, connecttimeout=opts.connect_timeout)
+    print "Forwarding %s to %s" % (proxy.port or opts.listen, args[0])
+    sys.stdout.flush()
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
+    for name in sorted(proxy.counts):
+        print "  %-12s %i" % (name, proxy.counts[name])
+
+if __name__ == "__main__":
+    main()
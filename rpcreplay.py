@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# rpcreplay.py - replay captured RPC calls against a server
+#
+# Requires python 2.7
+#
+# Reads a capture written by rpc.Capture (see RPCClient and RPCServer),
+# sends each call again with a fresh xid over its own connection, keeping
+# the original spacing or scaling it, and reports throughput and latency
+# percentiles.  Calls using RPCSEC_GSS can not be replayed, since their
+# contexts belong to the original session.
+#
+
+# Allow to be run stright from package root
+if  __name__ == "__main__":
+    import os.path
+    import sys
+    if os.path.isfile(os.path.join(sys.path[0], 'lib', 'testmod.py')):
+        sys.path.insert(1, os.path.join(sys.path[0], 'lib'))
+
+import sys
+import time
+import random
+import struct
+import socket
+import threading
+from optparse import OptionParser
+import rpc.rpc as rpc
+
+class Connection(object):
+    """One connection to the server, and a thread reading its replies"""
+    def __init__(self, replay):
+        self.replay = replay
+        path = rpc.unix_path(replay.host)
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((replay.host, replay.port))
+        self.thread = threading.Thread(target=self.reader,
+                                       name="replay %i" % self.sock.fileno())
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def send(self, data):
+        self.sock.send_record(data)
+
+    def reader(self):
+        while 1:
+            try:
+                reply = self.sock.recv_record()
+            except socket.error:
+                return
+            self.replay.got_reply(struct.unpack_from('>I', reply)[0])
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.thread.join()
+
+class Replay(object):
+    """Send captured calls to host and port, timing the replies
+
+    speed scales the time between calls, so 2 replays twice as fast as
+    captured; with a speed of 0 calls are sent as fast as possible.  If
+    connections is set, the captured connections are folded onto that
+    many, otherwise each gets its own.
+    """
+    def __init__(self, host, port, speed=1.0, connections=None):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.connections = connections
+        self.conns = {} # captured connection id -> Connection
+        self.lock = threading.Condition()
+        self.sent = {}  # xid -> time sent, until replied to
+        self.latencies = []
+        self.calls = 0
+        self.xid = random.randint(0, 0xffffffffL)
+
+    def run(self, records, timeout=10.0):
+        """Replay (time, connection id, record) tuples, in order
+
+        Returns once every call has a reply, or timeout seconds after the
+        last was sent.
+        """
+        base = start = None
+        for stamp, connid, data in records:
+            if base is None:
+                base = stamp
+                start = time.time()
+            elif self.speed:
+                wait = start + (stamp - base) / self.speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            if self.connections:
+                connid %= self.connections
+            conn = self.conns.get(connid)
+            if conn is None:
+                conn = self.conns[connid] = Connection(self)
+            self.xid = (self.xid + 1) & 0xffffffffL
+            self.lock.acquire()
+            self.sent[self.xid] = time.time()
+            self.calls += 1
+            self.lock.release()
+            conn.send([struct.pack('>I', self.xid), data[4:]])
+        if start is None:
+            return 0.0
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            while self.sent and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+        finally:
+            self.lock.release()
+        elapsed = time.time() - start
+        for conn in self.conns.values():
+            conn.close()
+        return elapsed
+
+    def got_reply(self, xid):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            sent = self.sent.pop(xid, None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+            if not self.sent:
+                self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+def percentile(values, p):
+    """Return the p'th percentile of a sorted list"""
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+def report(replay, elapsed):
+    replies = len(replay.latencies)
+    print "%i calls over %i connections in %.3f seconds" % \
+          (replay.calls, len(replay.conns), elapsed)
+    if replay.calls > replies:
+        print "%i calls got no reply" % (replay.calls - replies)
+    if not replies:
+        return
+    print "%.1f replies/s" % (replies / elapsed)
+    latencies = sorted(replay.latencies)
+    print "latency in msecs:"
+    for p in (50, 90, 99, 99.9):
+        print "  p%-5s %10.3f" % (p, percentile(latencies, p) * 1000)
+    print "  max    %10.3f" % (latencies[-1] * 1000)
+
+def main():
+    p = OptionParser("%prog [options] capture host [port]",
+                     description="Replay the calls in a capture written by "
+                     "rpc.Capture against the server at host and port.  "
+                     "host may be unix:/path for a Unix socket.")
+    p.add_option("-s", "--speed", type="float", default=1.0,
+                 help="Scale the time between calls, 0 for no waiting "
+                 "[%default]")
+    p.add_option("-c", "--connections", type="int", default=None,
+                 help="Fold the captured connections onto this many")
+    p.add_option("-t", "--timeout", type="float", default=10.0,
+                 help="Seconds to wait for replies after the last call "
+                 "[%default]")
+    opts, args = p.parse_args()
+    if len(args) not in (2, 3):
+        p.error("Need a capture file and a server")
+    port = 2049
+    if len(args) == 3:
+        port = int(args[2])
+    replay = Replay(args[1], port, opts.speed, opts.connections)
+    elapsed = replay.run(rpc.read_capture(args[0]), opts.timeout)
+    report(replay, elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,815 @@
+#!/usr/bin/env python
+# rpctest.py - unit tests for the rpc library
+#
+# Requires python 2.7
+#
+# Each test runs its servers in this process, on ports chosen by the
+# kernel, so the tests need nothing but the loopback interface.
+#
+
+# Allow to be run stright from package root
+if  __name__ == "__main__":
+    import os.path
+    import sys
+    if os.path.isfile(os.path.join(sys.path[0], 'lib', 'testmod.py')):
+        sys.path.insert(1, os.path.join(sys.path[0], 'lib'))
+
+import os
+import time
+import json
+import shutil
+import tempfile
+import socket
+import struct
+import signal
+import threading
+import unittest
+import rpc.rpc as rpc
+from rpc.rpcsec.sec_auth_none import SecAuthNone
+from rpc.rpcsec.sec_auth_sys import SecAuthSys
+import rpcproxy
+
+PROG = 0x40000000 + 54322
+
+class TestServer(rpc.RPCServer):
+    """Procedure 1 echoes its arguments; the others are set up by tests"""
+    def __init__(self, **kwargs):
+        kwargs.setdefault("port", 0)
+        rpc.RPCServer.__init__(self, prog=PROG, vers=1, **kwargs)
+
+    def handle_1(self, data, cred):
+        return rpc.SUCCESS, data
+
+class Stop(Exception):
+    pass
+
+def stop():
+    raise Stop
+
+def client(server, **kwargs):
+    return rpc.RPCClient('localhost', server.port, program=PROG, version=1,
+                         **kwargs)
+
+class RecordTest(unittest.TestCase):
+    def test_interrupted(self):
+        """A record arriving in pieces survives receive timeouts"""
+        fragments = ['first ', 'second fragment ', 'third']
+        data = ''
+        for i, frag in enumerate(fragments):
+            mark = len(frag)
+            if i == len(fragments) - 1:
+                mark |= 0x80000000L
+            data += struct.pack('>L', mark) + frag
+        end = len(data) - 1
+        data += struct.pack('>L', 0x80000004L) + 'next'
+        a, b = [socket.socket(_sock=sock) for sock in socket.socketpair()]
+        try:
+            a.settimeout(0.05)
+            # Split everywhere, including within record marks
+            for i in range(0, end, 3):
+                b.sendall(data[i:min(i + 3, end)])
+                self.assertRaises(socket.timeout, a.recv_record)
+            b.sendall(data[end:])
+            self.assertEqual(a.recv_record(), ''.join(fragments))
+            self.assertEqual(a.recv_record(), 'next')
+        finally:
+            a.close()
+            b.close()
+
+    def test_slow_reply(self):
+        """A client retransmitting part way through a reply still gets it"""
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        def serve():
+            sock, addr = listener.accept()
+            xid = sock.recv_record()[:4]
+            # Accepted, null verifier, SUCCESS
+            reply = xid + struct.pack('>5L', 1, 0, 0, 0, 0) + 'x' * 20
+            data = struct.pack('>L', 10) + reply[:10] + \
+                   struct.pack('>L', 10) + reply[10:20] + \
+                   struct.pack('>L', 0x80000000L | len(reply) - 20) + \
+                   reply[20:]
+            # Pause, so the client times out, at every few bytes
+            for i in range(0, len(data), 5):
+                sock.sendall(data[i:i + 5])
+                time.sleep(0.1)
+            sock.recv(1000)
+            sock.close()
+        t = threading.Thread(target=serve, name="slow server")
+        t.setDaemon(True)
+        t.start()
+        c = rpc.RPCClient('localhost', listener.getsockname()[1],
+                          program=PROG, version=1, timeout=10,
+                          retrans=100, timeo=0.05, backoff=1)
+        try:
+            self.assertEqual(c.call(1), 'x' * 20)
+        finally:
+            listener.close()
+        t.join()
+
+class ServerTestCase(unittest.TestCase):
+    """Runs servers started by start() until the test is over"""
+    def setUp(self):
+        self.threads = []
+
+    def tearDown(self):
+        for server, t in self.threads:
+            server.call_soon(stop)
+            t.join()
+
+    def start(self, server):
+        def serve():
+            try:
+                server.run()
+            except Stop:
+                pass
+        t = threading.Thread(target=serve, name="test server")
+        t.setDaemon(True)
+        t.start()
+        self.threads.append((server, t))
+        return server
+
+    def check_fails(self, server):
+        c = client(self.start(server), timeout=5)
+        try:
+            c.call(2)
+        except rpc.RPCAcceptError, e:
+            self.assertEqual(e.stat, rpc.SYSTEM_ERR)
+        else:
+            self.fail("call did not fail")
+        # The server is still going
+        self.assertEqual(c.call(1, 'more'), 'more')
+
+class HandlerErrorTest(ServerTestCase):
+    """Handlers that raise fail the call, rather than the server"""
+    def test_deferred_to_thread(self):
+        def fail():
+            raise ValueError("handler failed")
+        server = TestServer()
+        server.handle_2 = lambda data, cred: rpc.defer_to_thread(fail)
+        self.check_fails(server)
+
+    def test_coroutine(self):
+        def handle_2(data, cred):
+            yield rpc.defer_to_thread(lambda: (rpc.SUCCESS, ''))
+            raise ValueError("coroutine failed")
+        server = TestServer()
+        server.handle_2 = handle_2
+        self.check_fails(server)
+
+    def test_deferred_exception(self):
+        def handle_2(data, cred):
+            d = rpc.Deferred()
+            server.call_soon(d.callback, ValueError("deferred failed"))
+            return d
+        server = TestServer()
+        server.handle_2 = handle_2
+        self.check_fails(server)
+
+    def test_coroutine_exception(self):
+        def handle_2(data, cred):
+            d = rpc.Deferred()
+            server.call_soon(d.callback, ValueError("deferred failed"))
+            try:
+                yield d
+            except ValueError:
+                pass
+            else:
+                yield rpc.SUCCESS, 'not raised'
+            raise ValueError("coroutine caught it")
+        server = TestServer()
+        server.handle_2 = handle_2
+        self.check_fails(server)
+
+class WorkerErrorTest(ServerTestCase):
+    """A handler raising on a worker thread leaves the pool working"""
+    def check_raises(self, **kwargs):
+        server = TestServer(**kwargs)
+        def handle_2(data, cred):
+            raise ValueError("handler failed")
+        server.handle_2 = handle_2
+        self.check_fails(server)
+        return server
+
+    def test_workers(self):
+        self.check_raises(workers=1)
+
+    def test_ordered(self):
+        self.check_raises(workers=1, ordered=True)
+
+    def test_classifier(self):
+        server = self.check_raises(workers=1,
+                                   classifier=rpc.CallClassifier())
+        self.assertEqual(server.running, 0)
+
+def defer_echo(data, cred):
+    return rpc.defer_to_thread(lambda: (rpc.SUCCESS, data))
+
+class LoopbackTest(ServerTestCase):
+    def test_deferred_with_loop(self):
+        """Deferred replies are not missed while the server loop runs"""
+        server = self.start(TestServer())
+        server.handle_2 = defer_echo
+        c = rpc.RPCClient(server, program=PROG, version=1, timeout=2)
+        start = time.time()
+        for i in range(20):
+            self.assertEqual(c.call(2, str(i)), str(i))
+        self.assertTrue(time.time() - start < 2)
+
+    def test_deferred_without_loop(self):
+        """The client runs the server's queued calls if its loop is idle"""
+        server = TestServer()
+        server.handle_2 = defer_echo
+        c = rpc.RPCClient(server, program=PROG, version=1, timeout=2)
+        self.assertEqual(c.call(2, 'x'), 'x')
+
+    def check_one_at_a_time(self, server):
+        """Calls from several client threads run one at a time"""
+        state = {"running" : 0, "most" : 0, "threads" : set()}
+        def handle_2(data, cred):
+            state["running"] += 1
+            state["most"] = max(state["most"], state["running"])
+            state["threads"].add(threading.currentThread())
+            time.sleep(0.01)
+            state["running"] -= 1
+            return rpc.SUCCESS, data
+        server.handle_2 = handle_2
+        c = rpc.RPCClient(server, program=PROG, version=1, timeout=5)
+        def calls():
+            for i in range(10):
+                c.call(2, 'x')
+        threads = [threading.Thread(target=calls, name="loopback client")
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(state["most"], 1)
+        return state["threads"]
+
+    def test_serialised_with_loop(self):
+        server = self.start(TestServer())
+        threads = self.check_one_at_a_time(server)
+        self.assertEqual(threads, set([self.threads[0][1]]))
+
+    def test_serialised_without_loop(self):
+        self.check_one_at_a_time(TestServer())
+
+class PoolTest(ServerTestCase):
+    def test_reconnect_idle(self):
+        """reconnect drops the connection a thread has returned to the pool"""
+        server = self.start(TestServer())
+        c = client(server, timeout=5)
+        self.assertEqual(c.call(1, 'x'), 'x')
+        c.reconnect()
+        self.assertEqual(c.pool.count, 1)
+        self.assertEqual(c.call(1, 'y'), 'y')
+        for i in range(50):
+            if server.connection_stats()["open"] == 1:
+                break
+            time.sleep(0.1)
+        self.assertEqual(server.connection_stats()["open"], 1)
+
+class AsyncClientTest(ServerTestCase):
+    def test_udp(self):
+        """Without retransmission UDP is refused"""
+        server = self.start(TestServer(udp=True))
+        self.assertRaises(rpc.RPCError, rpc.AsyncRPCClient, 'localhost',
+                          server.port, program=PROG, version=1, proto='udp')
+
+    def test_timeout(self):
+        """Calls which time out are forgotten"""
+        server = TestServer()
+        server.handle_2 = lambda data, cred: rpc.Deferred()
+        self.start(server)
+        c = rpc.AsyncRPCClient('localhost', server.port, program=PROG,
+                               version=1, timeout=5)
+        d = c.call_async(2)
+        self.assertRaises(socket.timeout, d.wait, 0.1)
+        xid = c.send(2)
+        self.assertRaises(socket.timeout, c.listen, xid, 0.1)
+        self.assertEqual(c._calls, {})
+        self.assertEqual(c.call_async(1, 'x').wait(5), 'x')
+
+    def test_short_reply(self):
+        """A reply too short to decode does not stop the reader"""
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        def serve():
+            sock, addr = listener.accept()
+            sock.recv_record()
+            sock.send_record('abc')
+            sock.close()
+        t = threading.Thread(target=serve, name="short server")
+        t.setDaemon(True)
+        t.start()
+        try:
+            c = rpc.AsyncRPCClient('localhost', listener.getsockname()[1],
+                                   program=PROG, version=1, timeout=5)
+            d = c.call_async(1)
+            # Fails when the connection closes, rather than timing out
+            self.assertRaises(socket.error, d.wait, 5)
+            self.assertTrue(d.called)
+        finally:
+            listener.close()
+        t.join()
+
+    def test_loopback(self):
+        """Calls can be made to an RPCServer in this process"""
+        server = TestServer()
+        c = rpc.AsyncRPCClient(server, program=PROG, version=1, timeout=5)
+        self.assertEqual(c.call_async(1, 'x').wait(5), 'x')
+
+try:
+    from rpc.rpcsec.sec_auth_gss import SecAuthGss
+except ImportError:
+    SecAuthGss = None
+
+class HeaderCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        # Procedure 2 returns the credential it was called with
+        self.server.handle_2 = lambda data, cred: (rpc.SUCCESS, cred.body)
+
+    def test_auth_sys_changes(self):
+        """Packed headers are redone when the AUTH_SYS credential changes"""
+        sec = SecAuthSys(uid=1)
+        c = rpc.RPCClient(self.server, program=PROG, version=1,
+                          sec_list=[sec], timeout=5)
+        first = sec.cred
+        self.assertEqual(c.call(2), first)
+        self.assertEqual(c.call(2), first)
+        self.assertEqual(len(c._headers), 1)
+        sec.cred = SecAuthSys(uid=2).cred
+        self.assertEqual(c.call(2), sec.cred)
+        c.security = SecAuthSys(uid=3)
+        self.assertEqual(c.call(2), c.security.cred)
+        c.security = sec
+        sec.cred = first
+        self.assertEqual(c.call(2), first)
+
+    def check_not_cached(self, sec):
+        """Every call gets a freshly made header"""
+        c = rpc.RPCClient(self.server, program=PROG, version=1, timeout=5)
+        c.security = sec
+        header1, cred = c.get_call_header(1, PROG, 1, 2)
+        header2, cred = c.get_call_header(2, PROG, 1, 2)
+        self.assertEqual(c._headers, {})
+        self.assertNotEqual(header1[4:], header2[4:])
+
+    def test_varying_flavor(self):
+        class Sequenced(SecAuthNone):
+            fixed_header = False
+            seq = 0
+            def make_verf(self, data):
+                self.seq += 1
+                return rpc.opaque_auth(rpc.AUTH_NONE, str(self.seq))
+        self.check_not_cached(Sequenced())
+
+    @unittest.skipIf(SecAuthGss is None, "RPCSEC_GSS is not available")
+    def test_gss(self):
+        sec = SecAuthGss()
+        # Stand in for an established context, which needs a KDC
+        seq = [0]
+        def make_cred():
+            seq[0] += 1
+            return rpc.opaque_auth(rpc.RPCSEC_GSS, struct.pack('>L', seq[0]))
+        sec.make_cred = make_cred
+        sec.make_verf = lambda data: rpc.opaque_auth(rpc.RPCSEC_GSS, 'mic')
+        self.check_not_cached(sec)
+
+class HeaderDecodeTest(unittest.TestCase):
+    """The struct header decoders agree with unpack_rpc_msg"""
+    auths = [rpc.opaque_auth(rpc.AUTH_NONE, ''),
+             rpc.opaque_auth(rpc.AUTH_SYS,
+                             SecAuthSys(7, 'hostname1', 5, 6, [1, 2]).cred),
+             # Needs padding
+             rpc.opaque_auth(rpc.AUTH_SYS, 'x' * 5)]
+
+    def pack(self, msg, data='results'):
+        p = rpc.rpc_pack.RPCPacker()
+        p.pack_rpc_msg(msg)
+        return p.get_buffer() + data
+
+    def unpack(self, record):
+        p = rpc.rpc_pack.RPCUnpacker(record)
+        return p.unpack_rpc_msg(), p.get_position()
+
+    def check_same(self, out, record):
+        self.assertNotEqual(out, None)
+        msg, pos = self.unpack(record)
+        self.assertEqual(repr(out[0]), repr(msg))
+        self.assertEqual(out[1], pos)
+
+    def call(self, cred, verf):
+        body = rpc.call_body(rpc.RPCVERSION, PROG, 1, 3, cred, verf)
+        return self.pack(rpc.rpc_msg(12345, rpc.rpc_msg_body(rpc.CALL,
+                                                             cbody=body)))
+
+    def reply(self, verf, stat=rpc.SUCCESS):
+        areply = rpc.accepted_reply(verf, rpc.rpc_reply_data(stat, ''))
+        body = rpc.reply_body(rpc.MSG_ACCEPTED, areply, None)
+        return self.pack(rpc.rpc_msg(12345, rpc.rpc_msg_body(rpc.REPLY,
+                                                             rbody=body)))
+
+    def test_call(self):
+        for cred in self.auths:
+            for verf in self.auths:
+                record = self.call(cred, verf)
+                self.check_same(rpc.unpack_call_header(record), record)
+
+    def test_reply(self):
+        for verf in self.auths:
+            record = self.reply(verf)
+            self.check_same(rpc.unpack_reply_header(record), record)
+
+    def test_other_replies(self):
+        record = self.reply(self.auths[0], rpc.PROG_UNAVAIL)
+        self.assertEqual(rpc.unpack_reply_header(record), None)
+        rreply = rpc.rejected_reply(rpc.AUTH_ERROR, astat=rpc.AUTH_FAILED)
+        body = rpc.reply_body(rpc.MSG_DENIED, None, rreply)
+        record = self.pack(rpc.rpc_msg(12345, rpc.rpc_msg_body(rpc.REPLY,
+                                                               rbody=body)))
+        self.assertEqual(rpc.unpack_reply_header(record), None)
+        # A call is not a reply, nor the other way round
+        call = self.call(self.auths[0], self.auths[0])
+        self.assertEqual(rpc.unpack_reply_header(call), None)
+        self.assertEqual(rpc.unpack_call_header(self.reply(self.auths[0])),
+                         None)
+
+    def test_other_flavors(self):
+        gss = rpc.opaque_auth(rpc.RPCSEC_GSS, 'token')
+        record = self.call(gss, self.auths[0])
+        self.assertEqual(rpc.unpack_call_header(record), None)
+        self.assertEqual(rpc.unpack_reply_header(self.reply(gss)), None)
+
+    def test_truncated(self):
+        for verf in self.auths:
+            record = self.call(self.auths[1], verf)
+            end = self.unpack(record)[1]
+            for i in range(end):
+                self.assertEqual(rpc.unpack_call_header(record[:i]), None)
+            record = self.reply(verf)
+            end = self.unpack(record)[1]
+            for i in range(end):
+                self.assertEqual(rpc.unpack_reply_header(record[:i]), None)
+
+class ReplyCacheTest(unittest.TestCase):
+    def test_pending_kept(self):
+        """Calls in progress are not evicted to make room for replies"""
+        drc = rpc.ReplyCache(100)
+        self.assertEqual(drc.lookup('slow'), (False, None))
+        drc.lookup('a')
+        drc.store('a', 'a' * 60)
+        drc.lookup('b')
+        drc.store('b', 'b' * 60)
+        self.assertEqual(drc.lookup('slow'), (True, None))
+        self.assertEqual(drc.lookup('b'), (True, 'b' * 60))
+        self.assertEqual(drc.lookup('a'), (False, None))
+        stats = drc.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["bytes"], 60)
+        drc.store('slow', 'done')
+        self.assertEqual(drc.lookup('slow'), (True, 'done'))
+
+class DRCTest(ServerTestCase):
+    """The duplicate request cache only answers true retransmissions"""
+    def counting_server(self, **kwargs):
+        server = TestServer(drcsize=65536, **kwargs)
+        count = [0]
+        def handle_2(data, cred):
+            count[0] += 1
+            return rpc.SUCCESS, str(count[0])
+        server.handle_2 = handle_2
+        return self.start(server)
+
+    def check_clients(self, **kwargs):
+        server = self.counting_server(udp=True)
+        # Both clients use the same xids, from the same host
+        c1 = client(server, usenonrandomxid=True, timeout=5, **kwargs)
+        c2 = client(server, usenonrandomxid=True, timeout=5, **kwargs)
+        self.assertEqual(c1.call(2, 'same'), '1')
+        self.assertEqual(c2.call(2, 'same'), '2')
+
+    def test_tcp_clients(self):
+        self.check_clients()
+
+    def test_udp_clients(self):
+        self.check_clients(proto='udp')
+
+    def test_retransmit(self):
+        server = self.counting_server()
+        # xid, CALL, rpcvers, prog, vers, proc, null cred and verifier
+        call = struct.pack('>10L', 7, 0, 2, PROG, 1, 2, 0, 0, 0, 0)
+        sock = socket.create_connection(('localhost', server.port), 5)
+        try:
+            sock.send_record(call)
+            first = sock.recv_record()
+            sock.send_record(call)
+            self.assertEqual(sock.recv_record(), first)
+        finally:
+            sock.close()
+        self.assertEqual(server.drc.stats()["hits"], 1)
+
+    def test_reconnect(self):
+        """Calls replayed after a reconnect are answered from the cache"""
+        server = TestServer(drcsize=65536)
+        count = [0]
+        def handle_2(data, cred):
+            count[0] += 1
+            if count[0] > 1:
+                return rpc.SUCCESS, str(count[0])
+            d = rpc.Deferred()
+            def lose_reply():
+                for fd in list(server.sockets):
+                    server.event_close(fd)
+                d.callback((rpc.SUCCESS, str(count[0])))
+            server.call_soon(lose_reply)
+            return d
+        server.handle_2 = handle_2
+        self.start(server)
+        c = client(server, timeout=5)
+        self.assertEqual(c.call(2), '1')
+        self.assertEqual(count[0], 1)
+        self.assertEqual(server.drc.stats()["hits"], 1)
+
+    def test_in_progress(self):
+        """Datagrams resent while the call is running are dropped"""
+        server = TestServer(udp=True, drcsize=65536, workers=2)
+        count = [0]
+        def handle_2(data, cred):
+            count[0] += 1
+            time.sleep(0.3)
+            return rpc.SUCCESS, 'done'
+        server.handle_2 = handle_2
+        self.start(server)
+        c = client(server, proto='udp', timeout=2, timeo=0.05)
+        self.assertEqual(c.call(2), 'done')
+        self.assertEqual(count[0], 1)
+        self.assertEqual(client(server, timeout=2).call(1, 'more'), 'more')
+
+class MetricsTest(ServerTestCase):
+    def test_dump_while_recording(self):
+        """SIGUSR1 arriving while metrics are locked still dumps them"""
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "metrics.json")
+        old_handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            metrics = rpc.Metrics()
+            server = self.start(TestServer(metrics=metrics,
+                                           metricsfile=path))
+            self.assertEqual(client(server, timeout=5).call(1, 'x'), 'x')
+            # As if the signal came in the middle of Metrics.record
+            metrics.lock.acquire()
+            try:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            finally:
+                metrics.lock.release()
+            for i in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            fd = open(path)
+            try:
+                stats = json.load(fd)
+            finally:
+                fd.close()
+            self.assertEqual(stats["%i/1/1" % PROG]["calls"], 1)
+        finally:
+            signal.signal(signal.SIGUSR1, old_handler)
+            shutil.rmtree(tmpdir)
+
+class FairnessTest(ServerTestCase):
+    def light_latency(self, **kwargs):
+        """Time a call made behind 100 pipelined 10ms calls"""
+        server = TestServer(**kwargs)
+        def handle_2(data, cred):
+            time.sleep(0.01)
+            return rpc.SUCCESS, data
+        server.handle_2 = handle_2
+        self.start(server)
+        heavy = client(server, timeout=10)
+        light = client(server, timeout=10)
+        results = []
+        def pipeline():
+            results.extend(heavy.call_many([(2, 'x')] * 100))
+        t = threading.Thread(target=pipeline, name="heavy client")
+        t.start()
+        try:
+            # Let the server start on the heavy client's calls
+            time.sleep(0.05)
+            start = time.time()
+            self.assertEqual(light.call(2, 'y'), 'y')
+            latency = time.time() - start
+        finally:
+            t.join()
+        self.assertEqual(len(results), 100)
+        return latency
+
+    def test_batch(self):
+        """With batch, a light client is not stuck behind a heavy one"""
+        self.assertTrue(self.light_latency(batch=1) < 0.3)
+
+class BackpressureTest(ServerTestCase):
+    def check_bounded(self, **kwargs):
+        """Queued output stays near maxoutput while the client won't read"""
+        server = TestServer(maxoutput=200000, **kwargs)
+        server.handle_2 = lambda data, cred: (rpc.SUCCESS, 'x' * 100000)
+        self.start(server)
+        sock = socket.create_connection(('localhost', server.port), 5)
+        try:
+            # xid, CALL, rpcvers, prog, vers, proc, null cred and verifier
+            sock.send_records([struct.pack('>10L', xid, 0, 2, PROG, 1, 2,
+                                           0, 0, 0, 0)
+                               for xid in range(60)])
+            time.sleep(0.5)
+            # Each worker may add a reply once the limit is reached
+            self.assertTrue(server.output_stats()["queued"] < 800000)
+            self.assertTrue(server.output_stats()["stalls"] > 0)
+            xids = set()
+            for i in range(60):
+                reply = sock.recv_record()
+                xids.add(struct.unpack_from('>L', reply)[0])
+            self.assertEqual(xids, set(range(60)))
+        finally:
+            sock.close()
+
+    def test_loop(self):
+        self.check_bounded()
+
+    def test_workers(self):
+        self.check_bounded(workers=4)
+
+    def test_batch(self):
+        self.check_bounded(workers=4, batch=2)
+
+class ConnectionLimitTest(unittest.TestCase):
+    def test_evicted_with_event(self):
+        """An evicted connection's events later in the same batch are skipped"""
+        server = TestServer(engine='epoll', maxconns=1)
+        # Stop after handling a single batch of events
+        passes = [0]
+        def run_ready():
+            passes[0] += 1
+            if passes[0] > 1:
+                raise Stop
+            return False
+        server.run_ready = run_ready
+        a = socket.create_connection(('localhost', server.port), 5)
+        server.handle_connect(server.s.fileno())
+        b = socket.create_connection(('localhost', server.port), 5)
+        try:
+            # Reset a, so it has an event queued behind b's connect
+            a.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                         struct.pack('ii', 1, 0))
+            a.close()
+            time.sleep(0.1)
+            self.assertRaises(Stop, server.run)
+            stats = server.connection_stats()
+            self.assertEqual(stats["evicted"], 1)
+            self.assertEqual(stats["open"], 1)
+        finally:
+            b.close()
+
+def call_record(xid, proc, data=''):
+    """Return a call record to PROG with null credential and verifier"""
+    return struct.pack('>10L', xid, 0, 2, PROG, 1, proc, 0, 0, 0, 0) + data
+
+def reply_xid(reply):
+    return struct.unpack_from('>L', reply)[0]
+
+class ProxyTest(ServerTestCase):
+    def proxy(self, fault, **kwargs):
+        """Start a server behind a proxy applying fault to procedure 2"""
+        server = self.start(TestServer())
+        server.handle_2 = lambda data, cred: (rpc.SUCCESS, data)
+        proxy = rpcproxy.Proxy(('localhost', server.port), {2: fault},
+                               seed=1, **kwargs)
+        self.start(proxy)
+        sock = socket.create_connection(('localhost', proxy.port), 5)
+        self.addCleanup(sock.close)
+        return proxy, sock
+
+    def test_delay(self):
+        proxy, sock = self.proxy(rpcproxy.Fault(delay=0.2))
+        start = time.time()
+        sock.send_record(call_record(1, 2))
+        self.assertEqual(reply_xid(sock.recv_record()), 1)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(proxy.counts["delayed"], 1)
+
+    def test_drop(self):
+        proxy, sock = self.proxy(rpcproxy.Fault(drop=1.0))
+        sock.send_records([call_record(1, 2), call_record(2, 1)])
+        # Only the call to procedure 1 gets through
+        self.assertEqual(reply_xid(sock.recv_record()), 2)
+        self.assertEqual(proxy.counts["dropped"], 1)
+
+    def test_duplicate(self):
+        proxy, sock = self.proxy(rpcproxy.Fault(duplicate=1.0, side='reply'))
+        sock.send_record(call_record(1, 2, 'data'))
+        first = sock.recv_record()
+        self.assertEqual(reply_xid(first), 1)
+        self.assertEqual(sock.recv_record(), first)
+        self.assertEqual(proxy.counts["duplicated"], 1)
+
+    def test_reorder(self):
+        proxy, sock = self.proxy(rpcproxy.Fault(reorder=1.0), holdtime=5)
+        sock.send_records([call_record(1, 2), call_record(2, 1)])
+        # The held call goes after the one that overtook it
+        self.assertEqual(reply_xid(sock.recv_record()), 2)
+        self.assertEqual(reply_xid(sock.recv_record()), 1)
+        self.assertEqual(proxy.counts["reordered"], 1)
+
+    def test_connect_timeout(self):
+        """Connecting to a server which does not answer is given up"""
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(0)
+        # Fill the accept queue, so later connection attempts go unanswered
+        filler = socket.socket()
+        filler.connect(listener.getsockname())
+        proxy = self.start(rpcproxy.Proxy(listener.getsockname(),
+                                          connecttimeout=0.3))
+        sock = socket.create_connection(('localhost', proxy.port), 5)
+        try:
+            start = time.time()
+            # The poll loop is not held up meanwhile
+            sock2 = socket.create_connection(('localhost', proxy.port), 5)
+            sock2.close()
+            self.assertEqual(sock.recv(100), '')
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            sock.close()
+            filler.close()
+            listener.close()
+
+    def test_unreachable(self):
+        """A client whose server can't be reached is disconnected"""
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        proxy = self.start(rpcproxy.Proxy(('localhost', port)))
+        sock = socket.create_connection(('localhost', proxy.port), 5)
+        try:
+            self.assertEqual(sock.recv(100), '')
+        finally:
+            sock.close()
+
+    def test_reset_with_output(self):
+        """Resetting a connection skips output waiting on its other side"""
+        server = self.start(TestServer())
+        proxy = rpcproxy.Proxy(('localhost', server.port), engine='poll',
+                               faults={2: rpcproxy.Fault(reset=1.0)})
+        # Stop after handling a single batch of events
+        passes = [0]
+        def run_ready():
+            passes[0] += 1
+            if passes[0] > 1:
+                raise Stop
+            return False
+        proxy.run_ready = run_ready
+        sock = socket.create_connection(('localhost', proxy.port), 5)
+        try:
+            proxy.handle_connect(proxy.s.fileno())
+            cfd, = [fd for fd in proxy.sockets if fd not in proxy.upstream]
+            # xid, CALL, rpcvers, prog, vers, proc, null cred and verifier
+            sock.send_record(struct.pack('>10L', 1, 0, 2, PROG, 1, 1,
+                                         0, 0, 0, 0))
+            time.sleep(0.1)
+            # Leaves the call queued upstream, waiting for POLLOUT
+            proxy.handle_read(cfd)
+            sock.send_record(struct.pack('>10L', 2, 0, 2, PROG, 1, 2,
+                                         0, 0, 0, 0))
+            time.sleep(0.1)
+            self.assertRaises(Stop, proxy.run)
+            self.assertEqual(proxy.counts["resets"], 1)
+            self.assertEqual(proxy.sockets, {})
+        finally:
+            sock.close()
+
+class ForkTest(unittest.TestCase):
+    def test_forked_workers(self):
+        """Forked processes each get their own worker threads"""
+        server = TestServer(reuseport=True, backlog=64, workers=1)
+        server.handle_2 = lambda data, cred: (rpc.SUCCESS, str(os.getpid()))
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.run_forked(3)
+            finally:
+                os._exit(0)
+        try:
+            pids = set()
+            for i in range(30):
+                pids.add(client(server, timeout=2).call(2))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        self.assertEqual(len(pids), 3)
+
+if __name__ == "__main__":
+    unittest.main()